@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# --batch support for trx_to_rtx.py and partial.py
+# a manifest has one job per line, written as the arguments the script
+# would be given on the command line, relative to the manifest's directory
+# blank lines and lines starting with # are skipped
+import os, io, sys, time, shlex, importlib, traceback, contextlib, multiprocessing
+
+# jobs already run in a pool, and a pool's workers can't start their own
+# (both scripts turn off abbreviations, so these are the only spellings)
+Rejected = ('--jobs', '--batch')
+
+def read_manifest(fname):
+    jobs = []
+    with open(fname) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                args = shlex.split(line)
+                for a in args:
+                    if a.split('=')[0] in Rejected or a.startswith('-j'):
+                        sys.exit('%s:%s: %s can only be given on the command line, not in a manifest' % (fname, n, a))
+                jobs.append(args)
+    return jobs
+
+def init_worker(modname, cwd):
+    # each worker keeps what it has parsed, so files shared between
+    # jobs are only read once per worker
+    os.chdir(cwd)
+    importlib.import_module(modname).warm()
+
+def run_job(job):
+    modname, prog, i, args = job
+    mod = importlib.import_module(modname)
+    out = io.StringIO()
+    status = 0
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            mod.main(args, prog)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        out.write(traceback.format_exc())
+        status = 1
+    return i, status, time.time() - start, out.getvalue()
+
+def run_batch(manifest, modname, prog, jobs=1):
+    # runs every job in the manifest, prints a summary and returns the exit status
+    ls = read_manifest(manifest)
+    cwd = os.path.dirname(os.path.abspath(manifest))
+    start = time.time()
+    results = [None] * len(ls)
+    todo = [(modname, prog, i, a) for i, a in enumerate(ls)]
+    with multiprocessing.Pool(max(1, jobs), init_worker, (modname, cwd)) as pool:
+        for n, r in enumerate(pool.imap_unordered(run_job, todo)):
+            i, status, secs, log = r
+            results[i] = r
+            print('[%s/%s] %s %s (%.2fs)' % (n + 1, len(ls), 'ok' if status == 0 else 'FAILED', ' '.join(ls[i]), secs))
+            sys.stdout.flush()
+    print()
+    print('%-6s %8s  %s' % ('status', 'time', 'job'))
+    for i, status, secs, log in results:
+        print('%-6s %7.2fs  %s' % ('ok' if status == 0 else 'FAILED', secs, ' '.join(ls[i])))
+    failed = [r for r in results if r[1] != 0]
+    print('%s jobs, %s ok, %s failed, %.2fs' % (len(ls), len(ls) - len(failed), len(failed), time.time() - start))
+    for i, status, secs, log in failed:
+        print('\n--- %s\n%s' % (' '.join(ls[i]), log.rstrip()))
+    return 1 if failed else 0
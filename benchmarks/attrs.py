@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# times partial.py reading a big section-def-attrs:
+# 500 attrs of 10 values each, 5000 values in all, some shared between attrs
+# usage: attrs.py [n_attrs] [values_per_attr]
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lxml import etree
+import partial
+
+def make_section(n, k, seed=0):
+    rng = random.Random(seed)
+    xml = etree.Element('section-def-attrs')
+    for i in range(n):
+        at = etree.SubElement(xml, 'def-attr', n='a%s' % i)
+        for j in range(k):
+            # about one value in ten also appears in another attr
+            if rng.random() < 0.1:
+                v = 't%s_%s' % (rng.randrange(n), rng.randrange(k))
+            else:
+                v = 't%s_%s' % (i, j)
+            etree.SubElement(at, 'attr-item', tags=v)
+    return xml
+
+def naive(attrs):
+    # the nested loops partial.py used before the index
+    multi = []
+    inverse = {}
+    for k in attrs:
+        for v in attrs[k]:
+            if v in multi: continue
+            for k2 in attrs:
+                if k == k2: continue
+                if v in attrs[k2]:
+                    multi.append(v)
+                    break
+            else:
+                inverse[v] = k
+    return set(multi), inverse
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    root = etree.Element('transfer')
+    root.append(make_section(n, k))
+    partial.reset()
+    start = time.time()
+    partial.process_tree(root)
+    took = time.time() - start
+    print('%s attrs, %s values: %.3fs' % (n, n * k, took))
+    start = time.time()
+    multi, inverse = naive(partial.attrs)
+    print('without the index: %.3fs' % (time.time() - start))
+    assert multi == partial.multi_attrs and inverse == partial.attr_inverse
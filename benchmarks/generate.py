@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# writes synthetic but valid .t1x/.t2x files, for benchmarking
+# usage: generate.py [--stage t1x|t2x] [--rules N] [--depth N] [--fanout N]
+#                    [--lets N] [--attrs N] [--values N] [--seed N] out
+import random, argparse
+from xml.sax.saxutils import quoteattr
+
+def generate(stage='t1x', rules=100, depth=2, fanout=2, lets=2, attrs=5, values=5, seed=0):
+    # rules - number of rules
+    # depth - how deeply each rule nests <choose>
+    # fanout - how many macros each rule calls
+    # lets - how many clips each rule assigns to
+    # attrs, values - size of the tagset
+    rng = random.Random(seed)
+    root = 'transfer default="chunk"' if stage == 't1x' else 'interchunk'
+    ls = ['<?xml version="1.0" encoding="UTF-8"?>', '<%s>' % root]
+    ncats = 8
+    ls.append('  <section-def-cats>')
+    for i in range(ncats):
+        ls.append('    <def-cat n="c%s">' % i)
+        if stage == 't1x':
+            ls.append('      <cat-item tags="n%s.*"/>' % i)
+            ls.append('      <cat-item lemma="w%s" tags="v%s.*"/>' % (i, i))
+        else:
+            ls.append('      <cat-item tags="C%s.*"/>' % i)
+        ls.append('    </def-cat>')
+    ls.append('  </section-def-cats>')
+    ls.append('  <section-def-attrs>')
+    for k in range(attrs):
+        ls.append('    <def-attr n="a%s">' % k)
+        for j in range(values):
+            ls.append('      <attr-item tags="t%s_%s"/>' % (k, j))
+        ls.append('    </def-attr>')
+    ls.append('  </section-def-attrs>')
+    ls.append('  <section-def-vars>')
+    for v in range(2):
+        ls.append('    <def-var n="v%s"/>' % v)
+    ls.append('  </section-def-vars>')
+    ls.append('  <section-def-lists>')
+    ls.append('    <def-list n="l0">')
+    for j in range(values):
+        ls.append('      <list-item v="w%s"/>' % j)
+    ls.append('    </def-list>')
+    ls.append('  </section-def-lists>')
+    nmacros = max(4, fanout)
+    ls.append('  <section-def-macros>')
+    for m in range(nmacros):
+        k = rng.randrange(attrs)
+        ls.append('    <def-macro n="m%s" npar="2">' % m)
+        ls.append('      <choose>')
+        ls.append('        <when>')
+        ls.append('          <test><equal><clip pos="1" part="a%s"/><lit-tag v="t%s_%s"/></equal></test>' % (k, k, rng.randrange(values)))
+        ls.append('          <let><clip pos="2" part="a%s"/><clip pos="1" part="a%s"/></let>' % (k, k))
+        ls.append('        </when>')
+        ls.append('        <otherwise>')
+        ls.append('          <let><var n="v0"/><clip pos="1" part="a%s"/></let>' % k)
+        ls.append('        </otherwise>')
+        ls.append('      </choose>')
+        ls.append('    </def-macro>')
+    ls.append('  </section-def-macros>')
+    ls.append('  <section-rules>')
+    for i in range(rules):
+        ls.append('    <rule comment=%s>' % quoteattr('rule %s' % i))
+        ls.append('      <pattern><pattern-item n="c%s"/><pattern-item n="c%s"/></pattern>' % (rng.randrange(ncats), rng.randrange(ncats)))
+        ls.append('      <action>')
+        for l in range(lets):
+            k = rng.randrange(attrs)
+            ls.append('        <let><clip pos="%s" part="a%s"/><lit-tag v="t%s_%s"/></let>' % (rng.randrange(1, 3), k, k, rng.randrange(values)))
+        for f in range(fanout):
+            ls.append('        <call-macro n="m%s"><with-param pos="%s"/><with-param pos="%s"/></call-macro>' % (rng.randrange(nmacros), 1 + f % 2, 2 - f % 2))
+        ind = '        '
+        for d in range(depth):
+            k = rng.randrange(attrs)
+            ls.append(ind + '<choose>')
+            ls.append(ind + '  <when>')
+            ls.append(ind + '    <test><equal><clip pos="1" part="a%s"/><lit-tag v="t%s_%s"/></equal></test>' % (k, k, rng.randrange(values)))
+            ind += '    '
+        if depth:
+            ls.append(ind + '<let><clip pos="2" part="a0"/><clip pos="1" part="a0"/></let>')
+        for d in range(depth):
+            ind = ind[:-4]
+            ls.append(ind + '  </when>')
+            ls.append(ind + '  <otherwise>')
+            ls.append(ind + '    <let><var n="v1"/><lit v="x%s"/></let>' % d)
+            ls.append(ind + '  </otherwise>')
+            ls.append(ind + '</choose>')
+        ls.append('        <out>')
+        if stage == 't1x':
+            ls.append('          <chunk name="s%s" case="v0">' % i)
+            ls.append('            <tags><tag><lit-tag v="S%s"/></tag><tag><var n="v1"/></tag></tags>' % (i % ncats))
+            ls.append('            <lu><clip pos="1" part="lem"/><clip pos="1" part="a0"/><clip pos="1" part="a%s"/></lu>' % rng.randrange(attrs))
+            ls.append('            <b pos="1"/>')
+            ls.append('            <lu><clip pos="2" part="whole"/></lu>')
+            ls.append('          </chunk>')
+        else:
+            ls.append('          <chunk><clip pos="1" part="whole"/></chunk>')
+            ls.append('          <b pos="1"/>')
+            ls.append('          <chunk><clip pos="2" part="whole"/></chunk>')
+        ls.append('        </out>')
+        ls.append('      </action>')
+        ls.append('    </rule>')
+    ls.append('  </section-rules>')
+    ls.append('</%s>' % root.split()[0])
+    return '\n'.join(ls) + '\n'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out')
+    parser.add_argument('--stage', choices=['t1x', 't2x'], default='t1x')
+    parser.add_argument('--rules', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--lets', type=int, default=2)
+    parser.add_argument('--attrs', type=int, default=5)
+    parser.add_argument('--values', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+    out = args.pop('out')
+    with open(out, 'w') as f:
+        f.write(generate(**args))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# measures the memory taken by the rule IR: what tracemalloc still sees
+# allocated after process_file() on generated files, one with many inline
+# <choose> and one calling many macros
+# with --before REV, also measures trx_to_rtx.py as of git revision REV,
+# e.g. --before fddbc9f^ for the IR before it was slotted and interned
+# usage: memory.py [--before REV] [--rules N]
+import os, sys, argparse, tempfile, subprocess, tracemalloc
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+from lxml import etree
+from generate import generate
+
+# name: generate() arguments, for --rules N rules
+Inputs = {
+    'inline': lambda n: dict(rules=n, depth=4, fanout=0),
+    'macros': lambda n: dict(rules=n * 2 // 5, depth=1, fanout=8),
+}
+
+def measure(fname):
+    # run in a fresh process, with the trx_to_rtx.py to measure first on sys.path
+    import trx_to_rtx
+    root = etree.parse(fname, parser=etree.ETCompatXMLParser()).getroot()
+    tracemalloc.start()
+    rules = trx_to_rtx.process_file(root, 't1x')
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(len(rules), size)
+
+def run(tree, fname):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', tree, fname], check=True, capture_output=True, text=True).stdout
+    rules, size = out.split()[-2:]
+    return int(rules), int(size)
+
+def checkout(rev, dest):
+    git = ['git', '-C', os.path.join(here, '..')]
+    files = subprocess.run(git + ['archive', rev], check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', dest], input=files, check=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--before', metavar='REV')
+    parser.add_argument('--rules', type=int, default=3000)
+    parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        sys.path.insert(0, args.measure[0])
+        measure(args.measure[1])
+        sys.exit()
+    with tempfile.TemporaryDirectory() as tmp:
+        trees = [('now', os.path.join(here, '..'))]
+        if args.before:
+            os.mkdir(os.path.join(tmp, 'before'))
+            checkout(args.before, os.path.join(tmp, 'before'))
+            trees.insert(0, (args.before, os.path.join(tmp, 'before')))
+        for name, kw in Inputs.items():
+            fname = os.path.join(tmp, name + '.t1x')
+            with open(fname, 'w') as f:
+                f.write(generate(**kw(args.rules)))
+            for label, tree in trees:
+                rules, size = run(tree, fname)
+                print('%s, %s rules, %s: %s KiB' % (name, rules, label, size // 1024))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# exercises Rule.branches(), which follows every path through a rule:
+# a rule with n <choose> in a row testing a <var> can take 2^n paths,
+# so it has to run out of budget quickly rather than run out of memory,
+# and an <otherwise> after tests covering every value of an attr is
+# still reachable when the LU has none of them
+# usage: paths.py [n_chooses]
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lxml import etree
+import trx_to_rtx
+
+def rule(action):
+    xml = etree.fromstring('<rule><pattern><pattern-item n="c"/></pattern><action>%s</action></rule>' % action)
+    return trx_to_rtx.Rule(['c'], trx_to_rtx.parse_action(xml[1]), 1)
+
+def var_chooses(n):
+    return rule('<choose><when><test><equal><var n="v"/><lit v="x"/></equal></test><let><var n="w"/><lit v="y"/></let></when></choose>' * n)
+
+def covering():
+    # tests 1.gen against each of its values in turn
+    trx_to_rtx.Attrs['gen'] = ['m', 'f', 'nt']
+    whens = ''.join('<when><test><equal><clip pos="1" part="gen"/><lit-tag v="%s"/></equal></test><let><var n="w"/><lit v="%s"/></let></when>' % (v, v) for v in trx_to_rtx.Attrs['gen'])
+    return rule('<choose>%s<otherwise><let><var n="w"/><lit v="none"/></let></otherwise></choose>' % whens)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    trx_to_rtx.reset()
+    start = time.time()
+    reach = var_chooses(n).branches()
+    print('%s <choose> testing a var: %s in %.3fs' % (n, 'too many paths' if reach is None else 'followed', time.time() - start))
+    # each test keeps both copies of every state
+    assert (reach is None) == (2 ** (n + 1) - 2 > trx_to_rtx.PathBudget)
+    reach = covering().branches()
+    assert reach is not None
+    ch, = reach
+    print('<otherwise> after testing every value: reached by %s states' % len(reach[ch][-1]))
+    assert reach[ch][-1]
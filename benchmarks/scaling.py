@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# times each stage on generated files of increasing size along each axis,
+# and flags stages whose time grows faster than linearly in the size
+# usage: scaling.py [--axis AXIS]... [--repeat N] [--threshold SLOPE] [--quick]
+import os, io, sys, math, time, argparse, tempfile, contextlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lxml import etree
+import trx_to_rtx, partial
+from generate import generate
+
+# axis: (generate() argument, sizes)
+Axes = {
+    'rules': ('rules', [50, 100, 200, 400]),
+    # the size of the output grows exponentially with depth
+    'depth': ('depth', [1, 2, 3, 4]),
+    'fanout': ('fanout', [1, 2, 4, 8]),
+    'lets': ('lets', [2, 4, 8, 16]),
+    'tags': ('values', [20, 40, 80, 160]),
+}
+DocSizes = [1000, 2000, 4000, 8000]
+
+def best(f, repeat):
+    ret = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        t = time.perf_counter() - start
+        ret = t if ret is None else min(ret, t)
+    return ret
+
+def time_file(fname, repeat):
+    # returns {stage: seconds}
+    ret = {}
+    def read():
+        trx_to_rtx.reset()
+        return trx_to_rtx.process_file(etree.parse(fname, parser=etree.ETCompatXMLParser()).getroot(), 't1x')
+    ret['process_file'] = best(read, repeat)
+    def to_str():
+        rules = read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for r in rules:
+                r.to_str()
+            return time.perf_counter() - start
+    ret['Rule.to_str'] = min(to_str() for i in range(repeat))
+    def rewrite(part):
+        partial.reset()
+        partial.MODE = 't1x'
+        xml = partial.parse(fname)
+        start = time.perf_counter()
+        partial.process_tree(xml)
+        mid = time.perf_counter()
+        partial.clean_indent(xml)
+        return (mid - start, time.perf_counter() - mid)[part]
+    ret['process_node'] = min(rewrite(0) for i in range(repeat))
+    ret['clean_indent'] = min(rewrite(1) for i in range(repeat))
+    return ret
+
+def time_doc(n, repeat):
+    # a <choose> with n branches, each a small condition
+    def f():
+        ls = [trx_to_rtx.indent('', trx_to_rtx.indent('if ', trx_to_rtx.indent('(', '1.a%s/tl' % i, '=', 't%s' % i, ')'), ''), 'x', '') for i in range(n)]
+        trx_to_rtx.render(trx_to_rtx.indent('(', *ls, ')'))
+    return {'indent': best(f, repeat)}
+
+def slope(sizes, times):
+    # least squares fit of log(time) against log(size)
+    xs = [math.log(s) for s in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+def report(name, sizes, results, threshold):
+    # results is a list of {stage: seconds}, one for each size
+    print('%s: %s' % (name, ' '.join(str(s) for s in sizes)))
+    flagged = []
+    for stage in results[0]:
+        times = [r[stage] for r in results]
+        b = slope(sizes, times)
+        flag = b > threshold
+        if flag:
+            flagged.append((name, stage))
+        print('  %-14s %s  slope %.2f%s' % (stage, ' '.join('%8.4f' % t for t in times), b, '  SUPER-LINEAR' if flag else ''))
+    return flagged
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--axis', action='append', choices=list(Axes) + ['doc'], help='only run these axes')
+    parser.add_argument('--repeat', type=int, default=3, help='keep the best of N runs')
+    parser.add_argument('--threshold', type=float, default=1.3, help='flag slopes above this')
+    parser.add_argument('--quick', action='store_true', help='use the first three sizes of each axis')
+    args = parser.parse_args()
+    axes = args.axis or list(Axes) + ['doc']
+    flagged = []
+    with tempfile.TemporaryDirectory() as d:
+        for name in axes:
+            if name == 'doc':
+                sizes = DocSizes[:3] if args.quick else DocSizes
+                results = [time_doc(n, args.repeat) for n in sizes]
+            else:
+                arg, sizes = Axes[name]
+                sizes = sizes[:3] if args.quick else sizes
+                results = []
+                for n in sizes:
+                    fname = os.path.join(d, '%s-%s.t1x' % (name, n))
+                    with open(fname, 'w') as f:
+                        f.write(generate(**{arg: n}))
+                    results.append(time_file(fname, args.repeat))
+            flagged += report(name, sizes, results, args.threshold)
+    if flagged:
+        print('super-linear: %s' % ', '.join('%s/%s' % x for x in flagged))
+        sys.exit(1)
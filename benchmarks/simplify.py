@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# checks --simplify against truth tables: random and/or/not formulas over
+# a few atoms must mean the same after simplify(), and formulas with
+# more atoms than BDDAtoms go through normalize() alone
+# usage: simplify.py [n_formulas] [n_atoms]
+import os, sys, time, random, itertools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import trx_to_rtx
+from trx_to_rtx import Cond, Clip
+
+def formula(rng, ats, depth):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(ats)
+    op = rng.choice(['and', 'or', 'not'])
+    if op == 'not':
+        return Cond('not', [formula(rng, ats, depth - 1)])
+    return Cond(op, [formula(rng, ats, depth - 1) for i in range(rng.randint(2, 3))])
+
+def evaluate(c, env):
+    if isinstance(c, bool):
+        return c
+    if c.op == 'not':
+        return not evaluate(c.children[0], env)
+    if c.op == 'and':
+        return all(evaluate(x, env) for x in c.children)
+    if c.op == 'or':
+        return any(evaluate(x, env) for x in c.children)
+    return env[c]
+
+def check(rng, ats, depth):
+    c = formula(rng, ats, depth)
+    s = trx_to_rtx.simplify(c)
+    for vals in itertools.product([False, True], repeat=len(ats)):
+        env = dict(zip(ats, vals))
+        assert evaluate(c, env) == evaluate(s, env), (c, s, vals)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    rng = random.Random(0)
+    ats = [Cond('equal', [Clip('1', 'a%s' % i), Clip('lit', 'x')]) for i in range(k)]
+    start = time.time()
+    for i in range(n):
+        check(rng, ats, 4)
+    print('%s formulas over %s atoms: %.3fs' % (n, k, time.time() - start))
+    # too many atoms for the BDD; the truth table has 2^14 rows, so fewer of these
+    ats = [Cond('equal', [Clip('1', 'a%s' % i), Clip('lit', 'x')]) for i in range(trx_to_rtx.BDDAtoms + 2)]
+    start = time.time()
+    for i in range(n // 250):
+        check(rng, ats, 5)
+    print('%s formulas over %s atoms: %.3fs' % (n // 250, len(ats), time.time() - start))
@@ -0,0 +1,37 @@
+# simplifying <def-cat>s, shared by trx_to_rtx.py and partial.py
+# an item is covered by any item whose tags are a prefix of its own and
+# whose lemma is the same or empty, so only the most general items are kept
+# each lemma gets a trie of tags, making this linear in the total tag length
+
+def simplify_cat(items, key):
+    # key(item) gives (lemma, tuple of tags)
+    # kept items are ordered by the first item they cover
+    keys = [key(x) for x in items]
+    tries = {}
+    for i, (lm, tags) in enumerate(keys):
+        # a node is [children, index of the first item ending there]
+        node = tries.setdefault(lm, [{}, None])
+        for t in tags:
+            node = node[0].setdefault(t, [{}, None])
+        if node[1] is None:
+            node[1] = i
+    first = {}
+    for i, (lm, tags) in enumerate(keys):
+        k = cover(tries.get(''), tags)
+        if k is None:
+            k = cover(tries[lm], tags)
+        if k not in first:
+            first[k] = i
+    return [items[k] for k in sorted(first, key=first.get)]
+
+def cover(node, tags):
+    # the shortest item in the trie whose tags are a prefix of tags
+    if node is None:
+        return None
+    for t in tags:
+        if node[1] is not None:
+            break
+        node = node[0].get(t)
+        if node is None:
+            return None
+    return node[1]
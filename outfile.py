@@ -0,0 +1,31 @@
+# --keep-unchanged for trx_to_rtx.py and partial.py: leave the output
+# alone, mtime included, if converting again gave the same file, so
+# make doesn't rebuild everything that depends on it
+import os, shutil, hashlib, tempfile, contextlib
+
+def digest(f):
+    h = hashlib.sha1()
+    for block in iter(lambda: f.read(1 << 16), b''):
+        h.update(block)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def open_output(fname, keep_unchanged=False):
+    # yields a file to write fname with
+    if not keep_unchanged:
+        with open(fname, 'w') as f:
+            yield f
+        return
+    with tempfile.TemporaryFile('w+') as f:
+        yield f
+        f.flush()
+        f.buffer.seek(0)
+        new = digest(f.buffer)
+        if os.path.exists(fname):
+            with open(fname, 'rb') as old:
+                if digest(old) == new:
+                    print('%s unchanged' % fname)
+                    return
+        f.seek(0)
+        with open(fname, 'w') as out:
+            shutil.copyfileobj(f, out)
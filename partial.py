@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 from lxml import etree
-import sys, re
+import sys, os, io, re, copy, time, fcntl, argparse, tempfile, contextlib
+import batch, cattrie, outfile, runstats
 
 MODE = 't1x'
 
-patterns = []
+class Patterns:
+    # output patterns, numbered in the order they are first seen
+    def __init__(self):
+        self.parts = []
+        self.index = {}
+    def number(self, parts):
+        key = tuple(parts)
+        if key not in self.index:
+            self.index[key] = len(self.parts)
+            self.parts.append(parts)
+        return self.index[key]
+    def merge(self, other):
+        # adds other's patterns, returns the new number of each of them
+        return [self.number(p) for p in other.parts]
+    def read(self, f):
+        # reads the OPn lines written by write
+        for line in f:
+            line = line.strip()
+            if line.startswith('OP'):
+                s = line.split(': ', 1)[1].rstrip(';')
+                self.number(s.split('.') if s else [])
+    def write(self, f, ns=None):
+        for i in (range(len(self.parts)) if ns is None else ns):
+            f.write('OP%s: %s;\n' % (i, '.'.join(self.parts[i])))
+
+patterns = Patterns()
 pats = {}
 attrs = {}
-multi_attrs = []
+multi_attrs = set()
 attr_inverse = {}
+attr_index = {}
+pending = {}
+Trees = None
+Prof = None
+
+def timed(name):
+    # with --stats, adds the time spent inside it to stage name
+    return Prof.stage(name) if Prof else contextlib.nullcontext()
 
 def escape(s):
     if '.' in s or ' ' in s or s == '' or s.isnumeric():
@@ -16,40 +50,66 @@ def escape(s):
     else:
         return s
 
-def replace_with_str(xml, _s):
-    indent = '  '*(len(list(xml.iterancestors())))
+def attr_of(tag):
+    # the attr a tag belongs to, if it is only in one
+    return attr_inverse.get(tag)
+
+def replace_with_str(xml, _s, depth):
+    indent = '  '*depth
     par = xml.getparent()
     if xml.getnext() == None:
         s = _s + '\n' + indent[:-2]
     else:
         s = _s + '\n' + indent
-    if xml.getprevious() == None:
-        if not par.text:
-            par.text = '\n' + indent
-        par.text += s
-    else:
-        prev = xml.getprevious()
-        if not prev.tail:
-            prev.tail = '\n' + indent
-        prev.tail += s
+    # the text is collected in pending and written by flush_text
+    # once all of par's children are done
+    buf = pending.setdefault(par, {})
+    prev = xml.getprevious()
+    if prev not in buf:
+        if prev == None:
+            buf[prev] = [par.text or '\n' + indent]
+        else:
+            buf[prev] = [prev.tail or '\n' + indent]
+    buf[prev].append(s)
     par.remove(xml)
 
-def simplify_cat(cat):
-    ret = []
-    for op in sorted(cat, key=lambda x: len(x[0])):
-        for r in ret:
-            if op[0] and r[0] and op[0] != r[0]: continue
-            if op[1].startswith(r[1]): break
-            if r[1].startswith(op[1]):
-                r[1] = op[1]
-                break
+def flush_text(par):
+    for prev, ls in pending.pop(par, {}).items():
+        if prev == None:
+            par.text = ''.join(ls)
         else:
-            ret.append(op)
-    return ret
+            prev.tail = ''.join(ls)
+
+def simplify_cat(cat):
+    return cattrie.simplify_cat(cat, lambda x: (x[0], tuple(x[1].split('.')) if x[1] else ()))
 
-def process_node(xml):
+def process_tree(root, depth=0):
+    # children are rewritten before their parent is finished, using an
+    # explicit stack so deep trees don't run out of recursion
+    # entries are (node, depth, done, arg), done is set once its children are queued
+    stack = [(root, depth, False, None)]
+    starts = {}
+    while stack:
+        xml, depth, done, arg = stack.pop()
+        if done:
+            flush_text(xml)
+            if arg is not None:
+                finish_node(xml, depth, arg)
+            if xml in starts:
+                Prof.rule(xml.sourceline, time.perf_counter() - starts.pop(xml), len(etree.tostring(xml, with_tail=False)))
+            continue
+        if Prof and xml.tag == 'rule':
+            starts[xml] = time.perf_counter()
+        ls, arg = process_node(xml, depth)
+        if ls or arg is not None:
+            stack.append((xml, depth, True, arg))
+        for x in reversed(ls):
+            stack.append((x, depth + 1, False, None))
+
+def process_node(xml, depth):
+    # rewrites xml, or returns the children to process first and, if
+    # finish_node should run after them, what to pass it
     global patterns, pats, attrs, multi_attrs, attr_inverse
-    indent = '  '*(len(list(xml.iterancestors())) + 1)
     if xml.tag == 'def-cat':
         ls = []
         for x in xml:
@@ -65,52 +125,48 @@ def process_node(xml):
             xml.getparent().remove(xml)
     elif xml.tag == 'section-def-attrs':
         ls = []
-        for at in xml:
+        items = list(xml)
+        for at in items:
             name = at.attrib['n']
             vals = [v.attrib['tags'] for v in at]
             attrs[name] = vals
             ls.append('%s = %s ;' % (name, ' '.join(escape(v) for v in vals)))
         xml.clear()
         xml.text = '\n' + '\n'.join(ls) + '\n  '
-        for k in attrs:
+        # attr_index maps each value to the attrs it is in
+        names = [at.attrib['n'] for at in items]
+        for k in names:
+            for v in attrs[k]:
+                ks = attr_index.setdefault(v, [])
+                if k not in ks:
+                    ks.append(k)
+        for k in names:
             for v in attrs[k]:
                 if v in multi_attrs: continue
-                for k2 in attrs:
-                    if k == k2: continue
-                    if v in attrs[k2]:
-                        multi_attrs.append(v)
-                        break
+                if len(attr_index[v]) > 1:
+                    multi_attrs.add(v)
                 else:
                     attr_inverse[v] = k
     elif xml.tag == 'pattern-item':
         if xml.get('n') in pats:
-            replace_with_str(xml, pats[xml.get('n')])
+            replace_with_str(xml, pats[xml.get('n')], depth)
     elif xml.tag == 'clip':
         s = xml.attrib['pos'] + '.' + xml.attrib['part']
         if 'side' in xml.attrib:
             s += '/' + xml.attrib['side']
         if 'link-to' in xml.attrib:
             s = '%' + s
-        replace_with_str(xml, s)
+        replace_with_str(xml, s, depth)
     elif xml.tag in ['lit', 'lit-tag']:
-        replace_with_str(xml, escape(xml.attrib['v']))
+        replace_with_str(xml, escape(xml.attrib['v']), depth)
     elif xml.tag == 'tag':
-        waslit = (xml[0].tag == 'lit-tag')
-        process_node(xml[0])
-        if len(xml) == 0:
-            if waslit:
-                rep = xml.text.strip()
-                if rep[0] == '"' and rep[-1] == '"':
-                    rep = rep[1:-1]
-                replace_with_str(xml, rep)
-            else:
-                replace_with_str(xml, '[' + xml.text.strip() + ']')
+        return [xml[0]], (xml[0].tag == 'lit-tag')
     elif xml.tag == 'call-macro':
-        replace_with_str(xml, '%s(%s)' % (xml.attrib['n'], ', '.join(x.attrib['pos'] for x in xml)))
+        replace_with_str(xml, '%s(%s)' % (xml.attrib['n'], ', '.join(x.attrib['pos'] for x in xml)), depth)
     elif xml.tag == 'var':
-        replace_with_str(xml, '$$' + xml.attrib['n'])
+        replace_with_str(xml, '$$' + xml.attrib['n'], depth)
     elif xml.tag == 'lu' and MODE == 't1x' and xml[0].tag == 'var':
-        replace_with_str(xml, '$$' + xml[0].attrib['n'])
+        replace_with_str(xml, '$$' + xml[0].attrib['n'], depth)
     elif ((xml.tag == 'lu' and MODE == 't1x') or ((xml.tag == 'chunk') and MODE == 't2x')):
         parent_tags = []
         if MODE == 't1x':
@@ -119,10 +175,8 @@ def process_node(xml):
                 if t[0] == '[': continue
                 elif t[-1] == ']':
                     parent_tags.append(t.split('/')[0])
-                elif t in attr_inverse:
-                    parent_tags.append(attr_inverse[t])
                 else:
-                    parent_tags.append(None)
+                    parent_tags.append(attr_of(t))
         ok = True
         parts = []
         vals = []
@@ -148,9 +202,10 @@ def process_node(xml):
             elif pr.tag == 'lit' and len(parts) == 0:
                 vals.append('lemh=' + escape(pr.attrib['v']))
             elif pr.tag == 'lit-tag':
-                if pr.attrib['v'] in attr_inverse:
-                    parts.append(attr_inverse[pr.attrib['v']])
-                    vals.append(attr_inverse[pr.attrib['v']] + '=' + escape(pr.attrib['v']))
+                k = attr_of(pr.attrib['v'])
+                if k:
+                    parts.append(k)
+                    vals.append(k + '=' + escape(pr.attrib['v']))
                 elif pr.get('v').isnumeric():
                     linking = True
                     i = int(pr.get('v')) - 1
@@ -180,109 +235,260 @@ def process_node(xml):
                         s += '[' + t.get('n') + ']'
                     else:
                         s += t.get('v')
-                replace_with_str(xml, s)
+                replace_with_str(xml, s, depth)
             else:
-                ls = [x for x in xml]
-                for x in ls:
-                    process_node(x)
+                return [x for x in xml], None
         elif len(xml) == 1 and xml[0].tag == 'clip' and xml[0].attrib['part'] == 'whole':
             s = xml[0].attrib['pos']
             if 'side' in xml[0].attrib and xml[0].attrib['side'] != 'tl':
                 s += '/' + xml[0].attrib['side']
-            replace_with_str(xml, s)
+            replace_with_str(xml, s, depth)
         elif MODE == 't2x' and parts == ['tags'] and all(x.startswith('lem') for x in vals):
             s = src
             if vals:
                 s += '[' + ', '.join(vals) + ']'
-            replace_with_str(xml, s)
+            replace_with_str(xml, s, depth)
         else:
-            n = -1
-            for i, p in enumerate(patterns):
-                if p == parts:
-                    n = i
-                    break
-            else:
-                n = len(patterns)
-                patterns.append(parts)
-            s = '%s(OP%s)' % (src, n)
+            s = '%s(OP%s)' % (src, patterns.number(parts))
             if linking:
                 s = '%' + s
             if vals:
                 s += '[' + ', '.join(vals) + ']'
-            replace_with_str(xml, s)
+            replace_with_str(xml, s, depth)
     elif xml.tag == 'b':
         if 'pos' in xml.attrib:
-            replace_with_str(xml, '_' + xml.attrib['pos'])
+            replace_with_str(xml, '_' + xml.attrib['pos'], depth)
         else:
-            replace_with_str(xml, '_')
+            replace_with_str(xml, '_', depth)
     else:
-        ls = [x for x in xml]
-        for x in ls: process_node(x)
-        if len(xml) == 0:
-            lines = [x.strip() for x in (xml.text or '').strip().splitlines()]
-            if xml.tag in ['and', 'or', 'equal']:
-                op = xml.tag
-                if op == 'equal':
-                    op = '='
-                if 'caseless' in xml.attrib and xml.attrib['caseless'] == 'yes':
-                    op += 'cl'
-                op = ' ' + op + ' '
-                replace_with_str(xml, '(' + op.join(lines) + ')')
-            elif xml.tag == 'not':
-                replace_with_str(xml, '(not ' + xml.text.strip() + ')')
-            elif xml.tag == 'tags':
-                xml.text = '.'.join(lines)
-            elif xml.tag == 'let':
-                replace_with_str(xml, ' = '.join(lines))
-            elif xml.tag == 'pattern':
-                xml.text = ' '.join(lines)
-            elif xml.tag == 'out':
-                replace_with_str(xml, '[ ' + ' '.join(lines) + ' ]')
-            elif xml.tag == 'test':
-                replace_with_str(xml, xml.text.strip())
-            elif xml.tag == 'when' and len(lines) == 2:
-                replace_with_str(xml, 'if ' + ' '.join(lines))
-            elif xml.tag == 'otherwise' and len(lines) == 1:
-                replace_with_str(xml, 'else ' + lines[0])
-        elif len(xml) == 1 and xml.tag == 'chunk' and MODE == 't1x':
-            s = xml.attrib.get('name') or '*'
-            s += '@' + xml[0].text
-            ls = []
-            if 'case' in xml.attrib:
-                ls.append('lemcase=$$' + xml.attrib['case'])
-            if 'namefrom' in xml.attrib:
-                ls.append('lem=$$' + xml.attrib['namefrom'])
-            if ls:
-                s += ' [' + ', '.join(ls) + ']'
-            s += ' { ' + ' '.join(x.strip() for x in xml[0].tail.strip().splitlines()) + ' }'
-            replace_with_str(xml, s)
+        return [x for x in xml], False
+    return [], None
 
-def clean_indent(xml):
-    layer = len(list(xml.iterancestors()))
-    if not xml.text or xml.text.isspace():
+def finish_node(xml, depth, waslit):
+    if xml.tag == 'tag':
         if len(xml) == 0:
-            xml.text = None
-        else:
-            xml.text = '\n  ' + '  '*layer
-    if not xml.tail or xml.tail.isspace():
-        if xml.getnext() == None:
-            layer -= 1
-        xml.tail = '\n' + '  '*layer
-    for x in xml:
-        clean_indent(x)
+            if waslit:
+                rep = xml.text.strip()
+                if rep[0] == '"' and rep[-1] == '"':
+                    rep = rep[1:-1]
+                replace_with_str(xml, rep, depth)
+            else:
+                replace_with_str(xml, '[' + xml.text.strip() + ']', depth)
+    elif len(xml) == 0:
+        lines = [x.strip() for x in (xml.text or '').strip().splitlines()]
+        if xml.tag in ['and', 'or', 'equal']:
+            op = xml.tag
+            if op == 'equal':
+                op = '='
+            if 'caseless' in xml.attrib and xml.attrib['caseless'] == 'yes':
+                op += 'cl'
+            op = ' ' + op + ' '
+            replace_with_str(xml, '(' + op.join(lines) + ')', depth)
+        elif xml.tag == 'not':
+            replace_with_str(xml, '(not ' + xml.text.strip() + ')', depth)
+        elif xml.tag == 'tags':
+            xml.text = '.'.join(lines)
+        elif xml.tag == 'let':
+            replace_with_str(xml, ' = '.join(lines), depth)
+        elif xml.tag == 'pattern':
+            xml.text = ' '.join(lines)
+        elif xml.tag == 'out':
+            replace_with_str(xml, '[ ' + ' '.join(lines) + ' ]', depth)
+        elif xml.tag == 'test':
+            replace_with_str(xml, xml.text.strip(), depth)
+        elif xml.tag == 'when' and len(lines) == 2:
+            replace_with_str(xml, 'if ' + ' '.join(lines), depth)
+        elif xml.tag == 'otherwise' and len(lines) == 1:
+            replace_with_str(xml, 'else ' + lines[0], depth)
+    elif len(xml) == 1 and xml.tag == 'chunk' and MODE == 't1x':
+        s = xml.attrib.get('name') or '*'
+        s += '@' + xml[0].text
+        ls = []
+        if 'case' in xml.attrib:
+            ls.append('lemcase=$$' + xml.attrib['case'])
+        if 'namefrom' in xml.attrib:
+            ls.append('lem=$$' + xml.attrib['namefrom'])
+        if ls:
+            s += ' [' + ', '.join(ls) + ']'
+        s += ' { ' + ' '.join(x.strip() for x in xml[0].tail.strip().splitlines()) + ' }'
+        replace_with_str(xml, s, depth)
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: %s t*x_file rtx_file')
-        sys.exit(1)
-    xml = etree.parse(sys.argv[1], parser=etree.ETCompatXMLParser(remove_blank_text=True)).getroot()
-    MODE = sys.argv[1].split('.')[-1]
-    process_node(xml)
-    clean_indent(xml)
-    f = open(sys.argv[2], 'w')
-    f.write('! Generated by %s\n! Output patterns (can probably be renamed with search and replace)\n' % ' '.join(sys.argv))
-    for i, p in enumerate(patterns):
-        f.write('OP%s: %s;\n' % (i, '.'.join(p)))
+def clean_indent(root, depth=0):
+    stack = [(root, depth)]
+    while stack:
+        xml, depth = stack.pop()
+        layer = depth
+        if not xml.text or xml.text.isspace():
+            if len(xml) == 0:
+                xml.text = None
+            else:
+                xml.text = '\n  ' + '  '*layer
+        if not xml.tail or xml.tail.isspace():
+            if xml.getnext() == None:
+                layer -= 1
+            xml.tail = '\n' + '  '*layer
+        for x in reversed(xml):
+            stack.append((x, depth + 1))
+
+def reset():
+    # forget everything read by the previous conversion
+    global patterns, pats, attrs, multi_attrs, attr_inverse, attr_index, pending
+    patterns = Patterns()
+    pats = {}
+    attrs = {}
+    multi_attrs = set()
+    attr_inverse = {}
+    attr_index = {}
+    pending = {}
+
+def warm():
+    # keep parsed files between conversions, process_node changes
+    # the tree so each conversion gets a copy
+    global Trees
+    Trees = {}
+
+def parse(fname):
+    if Trees is None:
+        with timed('parse'):
+            return etree.parse(fname, parser=etree.ETCompatXMLParser(remove_blank_text=True, huge_tree=True)).getroot()
+    st = os.stat(fname)
+    path = os.path.abspath(fname)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with timed('parse'):
+        if path not in Trees or Trees[path][0] != stamp:
+            Trees[path] = (stamp, etree.parse(fname, parser=etree.ETCompatXMLParser(remove_blank_text=True, huge_tree=True)).getroot())
+        return copy.deepcopy(Trees[path][1])
+
+def share_patterns(fname):
+    # numbers the patterns to match those in fname, adding any new ones,
+    # so files converted with the same fname share their numbering
+    # returns the shared patterns and where each of ours went
+    shared = Patterns()
+    with open(fname, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        shared.read(f)
+        n = len(shared.parts)
+        ns = shared.merge(patterns)
+        shared.write(f, range(n, len(shared.parts)))
+    return shared, ns
+
+def renumber(text, ns):
+    return re.sub(r'\(OP(\d+)\)', lambda m: '(OP%s)' % ns[int(m.group(1))], text)
+
+def write_header(f, cmd, shared, header):
+    # writes the OPn lines, to header if given, and returns where each
+    # pattern went if they were renumbered
+    f.write('! Generated by %s\n! Output patterns (can probably be renamed with search and replace)\n' % (cmd or ' '.join(sys.argv)))
+    pt, ns = patterns, None
+    if shared:
+        pt, ns = share_patterns(shared)
+    if header:
+        with open(header, 'w') as h:
+            pt.write(h, sorted(set(ns)) if ns is not None else None)
+    else:
+        pt.write(f, sorted(set(ns)) if ns is not None else None)
     f.write('\n')
-    f.write(etree.tostring(xml, pretty_print=True, encoding='unicode'))
-    f.close()
+    return ns
+
+def convert(src, dst, cmd=None, shared=None, header=None, keep_unchanged=False):
+    global MODE
+    reset()
+    xml = parse(src)
+    MODE = src.split('.')[-1]
+    with timed('rewrite'):
+        process_tree(xml)
+    with timed('indent'):
+        clean_indent(xml)
+    with timed('write'):
+        text = etree.tostring(xml, pretty_print=True, encoding='unicode')
+        with outfile.open_output(dst, keep_unchanged) as f:
+            ns = write_header(f, cmd, shared, header)
+            f.write(renumber(text, ns) if ns else text)
+
+def write_part(xf, xml, depth):
+    # writes a finished top-level section or rule and throws it away
+    # its tail depends on what comes next, so the caller writes that
+    with timed('rewrite'):
+        process_tree(xml, depth)
+    with timed('indent'):
+        clean_indent(xml, depth)
+    with timed('write'):
+        xf.write(xml, with_tail=False)
+    xml.clear()
+    xml.getparent().remove(xml)
+
+def stream_convert(src, dst, cmd=None, shared=None, header=None, keep_unchanged=False):
+    # like convert, but writes each top-level section, and each rule, as
+    # soon as it has been read, so only one is in memory at a time
+    # the output is spooled until the patterns are all known
+    global MODE
+    reset()
+    MODE = src.split('.')[-1]
+    body = tempfile.TemporaryFile()
+    events = etree.iterparse(src, events=('start', 'end'), remove_blank_text=True, remove_comments=True, remove_pis=True, huge_tree=True)
+    ev, root = next(events)
+    with etree.xmlfile(body, encoding='utf-8') as xf:
+        with xf.element(root.tag, root.attrib), contextlib.ExitStack() as rules:
+            while True:
+                with timed('parse'):
+                    ev, x = next(events, (None, None))
+                if x is None:
+                    break
+                par = x.getparent()
+                if x is root:
+                    break
+                elif par is root and ev == 'start':
+                    xf.write('\n  ')
+                    if x.tag == 'section-rules':
+                        rules.enter_context(xf.element(x.tag, x.attrib))
+                elif par is root and x.tag == 'section-rules':
+                    # the last rule's tail
+                    xf.write('\n  ')
+                    rules.close()
+                    x.clear()
+                    root.remove(x)
+                elif par is root:
+                    write_part(xf, x, 1)
+                elif par.tag == 'section-rules' and par.getparent() is root and ev == 'end':
+                    xf.write('\n    ')
+                    write_part(xf, x, 2)
+            xf.write('\n')
+    body.write(b'\n\n')
+    body.seek(0)
+    with timed('write'), outfile.open_output(dst, keep_unchanged) as f:
+        ns = write_header(f, cmd, shared, header)
+        for line in io.TextIOWrapper(body, encoding='utf-8'):
+            f.write(renumber(line, ns) if ns else line)
+
+def main(argv, prog='partial.py'):
+    parser = argparse.ArgumentParser(prog=prog, add_help=False, allow_abbrev=False)
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--batch')
+    parser.add_argument('--patterns')
+    parser.add_argument('--header')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--stats')
+    parser.add_argument('--stats-top', type=int, default=10)
+    parser.add_argument('--keep-unchanged', action='store_true')
+    # options can come between the files
+    args, rest = parser.parse_known_intermixed_args(argv)
+    if args.batch and not args.files and not rest:
+        sys.exit(batch.run_batch(args.batch, 'partial', prog, args.jobs))
+    if args.batch or rest or len(args.files) != 2:
+        print('Usage: %s [--patterns FILE] [--header FILE] [--stream] [--keep-unchanged] [--stats FILE [--stats-top N]] t*x_file rtx_file\n       %s [-j N] --batch MANIFEST' % (prog, prog))
+        sys.exit(1)
+    global Prof
+    if args.stats:
+        Prof = runstats.Profile(args.stats_top)
+    run = stream_convert if args.stream else convert
+    try:
+        run(args.files[0], args.files[1], ' '.join([prog] + argv), args.patterns, args.header, args.keep_unchanged)
+    finally:
+        if Prof:
+            prof, Prof = Prof, None
+            prof.report(args.stats)
+
+if __name__ == '__main__':
+    main(sys.argv[1:], sys.argv[0])
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# runs trx_to_rtx.py or partial.py in rtx_server.py
+# e.g. rtx_client.py /tmp/rtx.sock trx_to_rtx.py apertium-eng-spa.eng-spa.t1x eng-spa.rtx
+# only uses the standard library so it starts quickly
+import os, sys, json, socket
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: %s SOCKET trx_to_rtx.py|partial.py|stop [args...]' % sys.argv[0])
+        sys.exit(1)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sys.argv[1])
+    with sock, sock.makefile('rwb') as f:
+        req = {'tool': os.path.basename(sys.argv[2]), 'args': sys.argv[3:], 'cwd': os.getcwd()}
+        f.write((json.dumps(req) + '\n').encode())
+        f.flush()
+        resp = json.loads(f.readline())
+    sys.stdout.write(resp['output'])
+    sys.exit(resp['status'])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# keeps the converters loaded, along with the files they have parsed and the
+# rules they have converted, and runs them for rtx_client.py
+import os, io, json, socket, argparse, traceback, contextlib
+import trx_to_rtx, partial
+
+Tools = {
+    'trx_to_rtx.py': trx_to_rtx.main,
+    'partial.py': partial.main,
+}
+
+def handle(req):
+    # req is {"tool": ..., "args": [...], "cwd": ...}
+    out = io.StringIO()
+    status = 0
+    old = os.getcwd()
+    try:
+        os.chdir(req['cwd'])
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            Tools[req['tool']](req['args'], req['tool'])
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            out.write('%s\n' % e.code)
+            status = 1
+    except Exception:
+        out.write(traceback.format_exc())
+        status = 1
+    finally:
+        os.chdir(old)
+    return {'status': status, 'output': out.getvalue()}
+
+def serve_one(conn):
+    # answers one request, returns False if it was to stop
+    # a bad request or a client that goes away only loses that connection
+    try:
+        with conn, conn.makefile('rwb') as f:
+            line = f.readline()
+            if not line:
+                return True
+            try:
+                req = json.loads(line)
+                tool = req.get('tool')
+            except (ValueError, AttributeError):
+                resp = {'status': 1, 'output': 'bad request %r\n' % line[:100].decode(errors='replace')}
+            else:
+                if tool == 'stop':
+                    f.write(b'{"status": 0, "output": ""}\n')
+                    return False
+                if tool not in Tools:
+                    resp = {'status': 1, 'output': 'unknown tool %r\n' % tool}
+                else:
+                    resp = handle(req)
+            f.write((json.dumps(resp) + '\n').encode())
+    except OSError as e:
+        print('lost a client: %s' % e)
+    return True
+
+def serve(path):
+    trx_to_rtx.warm()
+    partial.warm()
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    print('listening on %s' % path)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            if not serve_one(conn):
+                break
+    finally:
+        sock.close()
+        os.remove(path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='rtx_server.py SOCKET')
+    parser.add_argument('socket')
+    serve(parser.parse_args().socket)
@@ -0,0 +1,53 @@
+# --stats for trx_to_rtx.py and partial.py: time and memory for each stage,
+# the slowest and largest rules, and peak memory use
+import json, time, resource, tracemalloc
+
+class Profile:
+    def __init__(self, top=10):
+        self.top = top
+        self.stages = {}
+        self.stack = []
+        self.rules = []
+        tracemalloc.start()
+    def stage(self, name):
+        return Stage(self, name)
+    def rule(self, line, seconds, size):
+        self.rules.append({'line': line, 'seconds': seconds, 'size': size})
+    def report(self, fname, **extra):
+        # extra is added to the report as it is
+        ret = {'stages': self.stages}
+        ret['rules'] = len(self.rules)
+        ret['slowest rules'] = sorted(self.rules, key=lambda r: -r['seconds'])[:self.top]
+        ret['largest rules'] = sorted(self.rules, key=lambda r: -r['size'])[:self.top]
+        ret.update(extra)
+        ret['traced peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # ru_maxrss is in kilobytes on Linux
+        ret['peak rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        ret['peak rss of workers'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        with open(fname, 'w') as f:
+            json.dump(ret, f, indent=2)
+            f.write('\n')
+
+class Stage:
+    # times are exclusive: a stage entered inside another one,
+    # such as reading rules while rendering with --stream, isn't counted twice
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.mem = tracemalloc.get_traced_memory()[0]
+        self.inner = [0, 0]
+        self.prof.stack.append(self)
+    def __exit__(self, *exc):
+        self.prof.stack.pop()
+        secs = time.perf_counter() - self.start
+        mem = tracemalloc.get_traced_memory()[0] - self.mem
+        s = self.prof.stages.setdefault(self.name, {'seconds': 0, 'allocated': 0, 'calls': 0})
+        s['seconds'] += secs - self.inner[0]
+        s['allocated'] += mem - self.inner[1]
+        s['calls'] += 1
+        if self.prof.stack:
+            self.prof.stack[-1].inner[0] += secs
+            self.prof.stack[-1].inner[1] += mem
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from lxml import etree
-import re, copy, sys
+import re, sys, io, os, json, time, pickle, shutil, hashlib, tempfile, weakref, argparse, contextlib, multiprocessing
+import batch, cattrie, outfile, runstats
 
 # LIMITATIONS
 # Can't always infer tag order
@@ -16,28 +17,123 @@ Attrs = {}
 Vars = []
 Lists = {}
 Macros = {}
-Output = set()
-OutputTags = set()
-LetClips = []
+# ordered sets (the values are unused), so the output lists them in the
+# order they were first seen and doesn't change from run to run
+Output = {}
+OutputTags = {}
+MacroCache = {}
+MacroHits = 0
+MacroMisses = 0
+MacroCalls = {}
+ShareMacros = False
+MacroDefs = {}
+MacroNames = ''
+MacroStage = None
+SharedMacros = {}
+CacheDir = None
+CacheHits = 0
+CacheMisses = 0
+Simplify = False
+Stats = {}
+SourceHash = None
+MemCache = None
+Trees = None
+SnapshotDir = None
+SnapshotVersion = 2
+# rendered rule bodies by fingerprint, see body_key
+# only those of rules known to repeat are kept, so --stream stays small:
+# Repeated is filled in up front when all the rules are known,
+# otherwise a body is kept once a second rule with it turns up
+Bodies = {}
+BodySeen = set()
+Repeated = set()
+MacroDigests = {}
+Verbose = 0
+Prof = None
+
+class Group:
+    # laid out like "b1 part part b2" if that fits, otherwise one part per
+    # line indented inside the brackets
+    # widths are computed once when built, so layout is a single pass
+    def __init__(self, b1, parts, b2):
+        self.b1 = b1
+        self.b2 = b2
+        self.parts = [x for x in parts if x]
+        self.width = len(b1) + len(b2) + sum(doc_width(x) for x in self.parts) + max(len(self.parts) - 1, 0)
+        self.broken = sum(doc_width(x) for x in self.parts) > 40 or any(doc_multi(x) for x in self.parts)
+        self.multi = self.broken and (bool(b1) or bool(b2) or len(self.parts) > 1 or any(doc_multi(x) for x in self.parts))
+    def __bool__(self):
+        return bool(self.b1 or self.b2 or self.parts)
+
+class Concat:
+    def __init__(self, parts):
+        self.parts = [x for x in parts if x]
+        self.width = sum(doc_width(x) for x in self.parts)
+        self.multi = any(doc_multi(x) for x in self.parts)
+    def __bool__(self):
+        return bool(self.parts)
+
+def doc_width(doc):
+    return len(doc) if isinstance(doc, str) else doc.width
+
+def doc_multi(doc):
+    return '\n' in doc if isinstance(doc, str) else doc.multi
 
 def indent(*parts):
-    b1 = parts[0]
-    b2 = parts[-1]
-    rest = [x for x in parts[1:-1] if x]
-    if sum(len(x) for x in rest) > 40 or any('\n' in x for x in rest):
-        if b1: b1 += '\n  '
-        if b2: b2 = '\n' + b2
-        return b1 + '\n  '.join('\n'.join(rest).splitlines()) + b2
+    return Group(parts[0], parts[1:-1], parts[-1])
+
+def layout(doc, out, ind=''):
+    if isinstance(doc, str):
+        out.write(doc.replace('\n', '\n' + ind))
+    elif isinstance(doc, Concat):
+        for x in doc.parts:
+            layout(x, out, ind)
+    elif not doc.broken:
+        out.write(doc.b1)
+        for i, x in enumerate(doc.parts):
+            if i > 0:
+                out.write(' ')
+            layout(x, out, ind)
+        out.write(doc.b2)
     else:
-        return b1 + ' '.join(rest) + b2
+        ind2 = ind + '  '
+        if doc.b1:
+            out.write(doc.b1 + '\n' + ind2)
+        for i, x in enumerate(doc.parts):
+            if i > 0:
+                out.write('\n' + ind2)
+            layout(x, out, ind2)
+        if doc.b2:
+            out.write('\n' + ind + doc.b2)
+
+def render(doc):
+    out = io.StringIO()
+    layout(doc, out)
+    return out.getvalue()
 
-class LU:
+class Node:
+    # IR nodes are shared between rules (see MacroCache), so they are frozen
+    # fields are listed in __slots__ in the same order as the constructor's arguments
+    __slots__ = ()
+    def __init__(self, *vals):
+        for k, v in zip(self.__slots__, vals):
+            object.__setattr__(self, k, v)
+    def __setattr__(self, name, value):
+        raise AttributeError("can't modify %s.%s" % (type(self).__name__, name))
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, k) for k in self.__slots__))
+
+class LU(Node):
+    __slots__ = ('lemma', 'tags')
     tagclean = re.compile(r'\.\*(?=$|\.\*)')
     def __init__(self, lemma, tags):
-        self.lemma = lemma
-        self.tags = LU.tagclean.subn('', tags)[0].split('.')
+        if isinstance(tags, str):
+            tags = LU.tagclean.subn('', tags)[0].split('.')
+        Node.__init__(self, sys.intern(lemma), tuple(sys.intern(t) for t in tags))
     def __eq__(self, other):
         return isinstance(other, LU) and other.lemma == self.lemma and other.tags == self.tags
+    def __hash__(self):
+        return hash((self.lemma, self.tags))
     def to_str(self):
         s = '.'.join(self.tags)
         if self.lemma:
@@ -53,9 +149,8 @@ def read_cats(cat_section, suffix='t1x'):
             lm = ''
             if 'lemma' in op.attrib:
                 lm = op.attrib['lemma']
-            l = LU(lm, op.attrib['tags'])
-            if l not in v:
-                v.append(l)
+            v.append(LU(lm, op.attrib['tags']))
+        v = cattrie.simplify_cat(v, lambda l: (l.lemma, l.tags))
         if n in Cats:
             print('Warning: name conflict with pattern "%s"' % n)
         Cats[n] = v
@@ -92,26 +187,35 @@ def read_vars(var_section, suffix='t1x'):
     for v in var_section:
         Vars.append(v.attrib['n'])
 
-class Clip:
+class LetEnv:
+    # values assigned to each clip in a rule, substituted when it is printed
+    # assigned is the clips that are actually the target of a let
+    def __init__(self, lets, assigned=()):
+        self.assigned = set(assigned)
+        self.lets = {}
+        for c, v in lets:
+            self.lets.setdefault((c[0], c[1]), v)
+        self.busy = set()
+        self.docs = {}
+        # counts from rendering, see MacroCall
+        self.stats = {}
+
+class Clip(Node):
+    __slots__ = ('pos', 'part', 'side')
     def __init__(self, pos, part, side='tl'):
-        self.pos = pos
-        self.part = part
-        self.side = side
+        Node.__init__(self, sys.intern(pos), sys.intern(part), sys.intern(side))
     def get_clips(self):
         if self.pos == 'list' or self.pos == 'lit' or self.pos == 'b':
             return []
         return [[self.pos, self.part]]
-    def filter_out(self):
-        return self
-    def to_str(self):
-        global LetClips
-        for i in range(len(LetClips)):
-            if LetClips[i][0] == [self.pos, self.part]:
-                x = LetClips[i]
-                LetClips[i] = [None, None]
-                ret = x[1].to_str()
-                LetClips[i] = x
-                return ret
+    def to_doc(self, env):
+        key = (self.pos, self.part)
+        if key in env.lets and key not in env.busy:
+            # a let can refer to the old value of its own target
+            env.busy.add(key)
+            ret = env.lets[key].to_doc(env)
+            env.busy.remove(key)
+            return ret
         if self.pos == 'list' or self.pos == 'lit':
             if '.' in self.part or ' ' in self.part:
                 return '"' + self.part + '"'
@@ -125,128 +229,146 @@ class Clip:
         else:
             return '%s.%s/%s' % (self.pos, self.part, self.side)
 
-class Cond:
+class Cond(Node):
+    # hash-consed: building a condition identical to an existing one
+    # returns the existing object, so repeated tests are shared
+    # the table is weak, so conditions go once no rule uses them
+    # (with --stream, or between conversions in a server or batch worker)
+    __slots__ = ('op', 'children', '__weakref__')
+    table = weakref.WeakValueDictionary()
+    def __new__(cls, op, children):
+        children = tuple(children)
+        key = (op,) + tuple((c.pos, c.part, c.side) if isinstance(c, Clip) else c for c in children)
+        self = Cond.table.get(key)
+        if self is None:
+            self = Node.__new__(cls)
+            Node.__init__(self, sys.intern(op), children)
+            Cond.table[key] = self
+        return self
     def __init__(self, op, children):
-        self.op = op
-        self.children = children
+        pass
+    def __reduce__(self):
+        return (Cond, (self.op, self.children))
     def get_clips(self):
         ret = []
         for c in self.children:
             ls = c.get_clips()
             ret += [l for l in ls if l not in ret]
         return ret
-    def to_str(self):
+    def to_doc(self, env):
+        key = (self, frozenset(env.busy)) if env.busy else self
+        if key not in env.docs:
+            env.docs[key] = self.make_doc(env)
+        return env.docs[key]
+    def make_doc(self, env):
         if self.op == 'not':
-            return indent('(', 'not', self.children[0].to_str(), ')')
+            return indent('(', 'not', self.children[0].to_doc(env), ')')
         elif self.op in ['and', 'or']:
-            ls = [self.children[0].to_str()]
+            ls = [self.children[0].to_doc(env)]
             for i in self.children[1:]:
                 ls.append(self.op)
-                ls.append(i.to_str())
+                ls.append(i.to_doc(env))
             return indent('(', *ls, ')')
         else:
-            return indent('(', self.children[0].to_str(), self.op, self.children[1].to_str(), ')')
+            return indent('(', self.children[0].to_doc(env), self.op, self.children[1].to_doc(env), ')')
 
-class Choose:
+class Choose(Node):
+    __slots__ = ('test', 'do', 'otherwise')
     def __init__(self, test, do, otherwise):
-        self.test = test
-        self.do = do
-        self.otherwise = otherwise
+        Node.__init__(self, tuple(test), tuple(do), otherwise)
     def get_clips(self):
         ret = []
-        for c in self.test + self.do + [self.otherwise]:
+        for c in self.test + self.do + (self.otherwise,):
             ls = c.get_clips()
             ret += [l for l in ls if l not in ret]
         return ret
-    def filter(self, clip):
-        return Choose(self.test, [x.filter(clip) for x in self.do], self.otherwise.filter(clip))
-    def filter_reject(self):
+    def analyse(self, an):
+        for t in self.test:
+            an.read(t)
+        ds = [d.analyse(an) for d in self.do]
+        o = self.otherwise.analyse(an)
+        if all(d.let is x for d, x in zip(ds, self.do)) and o.let is self.otherwise:
+            let = self
+        else:
+            let = Choose(self.test, [d.let for d in ds], o.let)
+        skel = Choose(self.test, [d.skel for d in ds], o.skel)
+        match = {}
+        for x in ds + [o]:
+            for c in x.match:
+                if c not in match:
+                    match[c] = Choose(self.test, [d.match.get(c, d.skel) for d in ds], o.match.get(c, o.skel))
         ops = []
-        for i, d in enumerate(self.do):
-            r = d.filter_reject()
-            if r == True:
+        for i, d in enumerate(ds):
+            if d.rej is True:
                 ops.append(self.test[i])
-            elif isinstance(r, Cond):
-                ops.append(Cond('and', [self.test[i], r]))
-        r = self.otherwise.filter_reject()
-        if r:
-            o = Cond('not', [Cond('or', self.test)])
-            if isinstance(r, Cond):
-                o = Cond('and', [o, r])
-            ops.append(o)
-        if len(ops) > 0:
-            return Cond('or', ops)
+            elif isinstance(d.rej, Cond):
+                ops.append(Cond('and', [self.test[i], d.rej]))
+        if o.rej:
+            r = Cond('not', [Cond('or', self.test)])
+            if isinstance(o.rej, Cond):
+                r = Cond('and', [r, o.rej])
+            ops.append(r)
+        rej = Cond('or', ops) if ops else False
+        if all(d.out is x for d, x in zip(ds, self.do)) and o.out is self.otherwise:
+            out = self
         else:
-            return False
-    def filter_out(self):
-        return Choose(self.test, [x.filter_out() for x in self.do], self.otherwise.filter_out())
-    def filter_let(self):
-        return Choose(self.test, [x.filter_let() for x in self.do], self.otherwise.filter_let())
-    def to_str(self):
+            out = Choose(self.test, [d.out for d in ds], o.out)
+        return Pieces(let, skel, match, rej, out)
+    def to_doc(self, env):
         ls = []
         for i, d in enumerate(self.do):
-            s = d.to_str()
+            s = d.to_doc(env)
             if s:
-                ls.append(indent('', indent('if ', self.test[i].to_str(), ''), s, ''))
-        s = self.otherwise.to_str()
+                ls.append(indent('', indent('if ', self.test[i].to_doc(env), ''), s, ''))
+        s = self.otherwise.to_doc(env)
         if s:
-            ls.append('else ' + s)
+            ls.append(Concat(['else ', s]))
         return indent('(', *ls, ')')
 
-class ActionBlock:
+class ActionBlock(Node):
+    __slots__ = ('parts',)
     def __init__(self, parts):
-        self.parts = parts
+        Node.__init__(self, tuple(parts))
     def get_clips(self):
         ret = []
         for c in self.parts:
             ls = c.get_clips()
             ret += [l for l in ls if l not in ret]
         return ret
-    def filter(self, clip):
-        l = [x.filter(clip) for x in self.parts if not isinstance(x, Clip)]
-        if len(l) == 1:
-            return l[0]
-        else:
-            return ActionBlock(l)
-    def filter_reject(self):
+    def analyse(self, an):
+        ps = [None if isinstance(x, Clip) else x.analyse(an) for x in self.parts]
+        let, skel, match = let_block(self, [p for p in ps if p])
         ops = []
-        for p in self.parts:
-            r = p.filter_reject()
-            if r == True:
-                return True
-            elif isinstance(r, Cond):
-                ops.append(r)
-        if len(ops) > 0:
-            return Cond('or', ops)
-        else:
-            return False
-    def filter_out(self):
-        ls = []
-        for p in self.parts:
-            f = p.filter_out()
-            if not isinstance(f, ActionBlock) or len(f.parts) > 0:
-                ls.append(f)
-        if len(ls) == 1:
-            return ls[0]
-        return ActionBlock(ls)
-    def filter_let(self):
-        ls = []
-        for p in self.parts:
-            if isinstance(p, Clip):
+        rej = False
+        for p in ps:
+            if p is None:
                 continue
-            f = p.filter_let()
+            if p.rej is True:
+                rej = True
+                break
+            elif isinstance(p.rej, Cond):
+                ops.append(p.rej)
+        if rej is not True and ops:
+            rej = Cond('or', ops)
+        ls = []
+        for x, p in zip(self.parts, ps):
+            f = x if p is None else p.out
             if not isinstance(f, ActionBlock) or len(f.parts) > 0:
                 ls.append(f)
         if len(ls) == 1:
-            return ls[0]
-        return ActionBlock(ls)
-    def to_str(self):
-        return indent('', *[x.to_str() for x in self.parts], '').strip()
+            out = ls[0]
+        elif len(ls) == len(self.parts) and all(f is x for f, x in zip(ls, self.parts)):
+            out = self
+        else:
+            out = ActionBlock(ls)
+        return Pieces(let, skel, match, rej, out)
+    def to_doc(self, env):
+        return indent('', *[x.to_doc(env) for x in self.parts], '')
 
-class Action:
+class Action(Node):
+    __slots__ = ('name', 'parts')
     def __init__(self, name, parts):
-        self.name = name
-        self.parts = parts
+        Node.__init__(self, sys.intern(name), tuple(parts))
         if None in self.parts:
             raise Exception('None!')
     def get_clips(self):
@@ -254,43 +376,32 @@ class Action:
             return self.parts[0].get_clips()
         else:
             return []
-    def filter(self, clip):
-        if self.name == 'let' and self.parts[0].get_clips()[0] == clip and self.parts[0].side == 'tl':
-            return self
-        elif self.name == 'out':
-            return ActionBlock([x for x in self.parts if not isinstance(x, Clip)]).filter(clip)
-        else:
-            return ActionBlock([])
-    def filter_reject(self):
-        if self.name == 'reject-current-rule':
-            return True
-        else:
-            return False
-    def filter_out(self):
-        if self.name == 'out':
-            l = []
-            for p in self.parts:
-                if isinstance(p, Clip):
-                    l.append(p)
-                else:
-                    l.append(p.filter_out())
-            return Action(self.name, l)
-        elif self.name == 'lu':
-            return self
-        else:
-            return ActionBlock([])
-    def filter_let(self):
+    def analyse(self, an):
         if self.name == 'let':
-            return self
+            an.read(self.parts[0])
+            cl = self.parts[0].get_clips()
+            match = {}
+            if cl and self.parts[0].side == 'tl':
+                match[tuple(cl[0])] = self
+            return Pieces(self, ActionBlock([]), match, False, ActionBlock([]))
         elif self.name == 'out':
-            return ActionBlock([x for x in self.parts if not isinstance(x, Clip)]).filter_let()
+            ps = [None if isinstance(x, Clip) else x.analyse(an) for x in self.parts]
+            let, skel, match = let_block(None, [p for p in ps if p])
+            if all(p is None or p.out is x for x, p in zip(self.parts, ps)):
+                out = self
+            else:
+                out = Action(self.name, [x if p is None else p.out for x, p in zip(self.parts, ps)])
+            return Pieces(let, skel, match, False, out)
+        elif self.name == 'lu':
+            return Pieces(ActionBlock([]), ActionBlock([]), {}, False, self)
         else:
-            return ActionBlock([])
-    def to_str(self):
+            rej = (self.name == 'reject-current-rule')
+            return Pieces(ActionBlock([]), ActionBlock([]), {}, rej, ActionBlock([]))
+    def to_doc(self, env):
         if self.name == 'let':
-            return self.parts[1].to_str()
+            return self.parts[1].to_doc(env)
         elif self.name == 'out':
-            return indent('[', *[x.to_str() for x in self.parts], ']')
+            return indent('[', *[x.to_doc(env) for x in self.parts], ']')
         elif self.name == 'lu':
             frame = '*(something)'
             ls = []
@@ -299,9 +410,9 @@ class Action:
                     if l.part == 'whole':
                         frame = l.pos
                     else:
-                        ls.append(l.part + '=' + l.to_str() + ',')
+                        ls.append(Concat([l.part + '=', l.to_doc(env), ',']))
                 else:
-                    ls.append('something=' + l.to_str() + ',')
+                    ls.append(Concat(['something=', l.to_doc(env), ',']))
             if ls:
                 return indent(frame + '[', *ls, ']')
             else:
@@ -309,6 +420,256 @@ class Action:
         else:
             return ''
 
+class MacroCall(Node):
+    # a call to a macro that only outputs, with --share-macros: the macro
+    # is written once in the MACROS section and this refers to it, unless
+    # the rule lets something the macro reads, in which case the
+    # expansion in body is written instead
+    # size is about how long body is when written out
+    __slots__ = ('name', 'args', 'body', 'reads', 'size')
+    def __init__(self, name, args, body, reads=None, size=None):
+        if reads is None:
+            reads = frozenset((x.pos, x.part) for x in walk(body) if isinstance(x, Clip))
+            size = len(render(body.to_doc(LetEnv([]))))
+        Node.__init__(self, sys.intern(name), tuple(args), body, reads, size)
+    def get_clips(self):
+        return self.body.get_clips()
+    def analyse(self, an):
+        p = self.body.analyse(an)
+        out = self if p.out is self.body else MacroCall(self.name, self.args, p.out, self.reads, self.size)
+        return Pieces(p.let, p.skel, p.match, p.rej, out)
+    def to_doc(self, env):
+        if any(c in env.assigned for c in self.reads):
+            env.stats['shared macro calls inlined'] = env.stats.get('shared macro calls inlined', 0) + 1
+            return self.body.to_doc(env)
+        s = '%s(%s)' % (self.name, ', '.join(self.args))
+        env.stats['shared macro calls'] = env.stats.get('shared macro calls', 0) + 1
+        env.stats['shared macro bytes saved'] = env.stats.get('shared macro bytes saved', 0) + self.size - len(s)
+        return s
+
+def walk(node):
+    # node and everything under it
+    todo = [node]
+    while todo:
+        x = todo.pop()
+        if isinstance(x, tuple):
+            todo.extend(x)
+        elif isinstance(x, Node):
+            yield x
+            todo.extend(getattr(x, k) for k in x.__slots__ if k != '__weakref__')
+
+def macro_def(name):
+    # what --share-macros calls the macro, or None if it does more than
+    # output and so has to be inlined
+    if name not in MacroDefs:
+        body = parse_action(Macros[name])
+        if any(isinstance(x, Action) and x.name in ['let', 'reject-current-rule'] for x in walk(body)):
+            MacroDefs[name] = None
+        else:
+            doc = render(Analysis(body).out.to_doc(LetEnv([])))
+            # the t1x and t2x can both have a macro with this name,
+            # so the name says which file it came from
+            n = '%s_%s' % (name, MacroStage)
+            SharedMacros[n] = (int(Macros[name].get('npar', 0)), doc)
+            MacroDefs[name] = n
+    return MacroDefs[name]
+
+def define_macros(stage):
+    # with --share-macros, names every macro as soon as they are read, so
+    # the names are the same in rules from the cache or a snapshot
+    global MacroStage, MacroNames
+    if ShareMacros:
+        MacroStage = stage
+        for n in Macros:
+            macro_def(n)
+        MacroNames = repr(sorted(MacroDefs.items()))
+
+class Pieces:
+    # what a node contributes to each section of the rule:
+    # let - the lets and the control flow around them
+    # skel - let with no targets kept, match - let with each target kept
+    # rej - when the rule rejects, out - the output
+    def __init__(self, let, skel, match, rej, out):
+        self.let = let
+        self.skel = skel
+        self.match = match
+        self.rej = rej
+        self.out = out
+
+def let_block(block, ps):
+    ps = [p for p in ps if not isinstance(p.let, ActionBlock) or len(p.let.parts) > 0]
+    if len(ps) == 1:
+        return ps[0].let, ps[0].skel, ps[0].match
+    if block and len(ps) == len(block.parts) and all(p.let is x for p, x in zip(ps, block.parts)):
+        let = block
+    else:
+        let = ActionBlock([p.let for p in ps])
+    match = {}
+    for p in ps:
+        for c in p.match:
+            if c not in match:
+                match[c] = ActionBlock([q.match.get(c, q.skel) for q in ps])
+    return let, ActionBlock([p.skel for p in ps]), match
+
+class Analysis:
+    # splits a rule's actions into lets, reject conditions and output
+    # in a single walk of the tree
+    def __init__(self, act):
+        self.clips = {}
+        p = act.analyse(self)
+        self.lets = {c: p.match.get(c, p.skel) for c in self.clips}
+        self.assigned = set(p.match)
+        self.reject = p.rej
+        self.out = p.out
+    def read(self, node):
+        for c in node.get_clips():
+            self.clips.setdefault(tuple(c), None)
+
+# reject guards are built by or-ing together every path to a rejection,
+# so they repeat themselves a lot
+# atoms are the comparisons at the leaves, which are hash-consed,
+# so identical atoms are the same object
+
+BDDAtoms = 12
+
+def is_op(c, op):
+    return isinstance(c, Cond) and c.op == op
+
+def negate(c):
+    if isinstance(c, bool):
+        return not c
+    if is_op(c, 'not'):
+        return c.children[0]
+    return Cond('not', [c])
+
+def guard_size(c, memo=None):
+    if memo is None:
+        memo = {}
+    if not isinstance(c, Cond) or c.op not in ['and', 'or', 'not']:
+        return 1
+    if c not in memo:
+        memo[c] = 1 + sum(guard_size(x, memo) for x in c.children)
+    return memo[c]
+
+def sort_key(c, memo):
+    if c not in memo:
+        if isinstance(c, Cond):
+            memo[c] = (c.op, tuple(sort_key(x, memo) for x in c.children))
+        elif isinstance(c, Clip):
+            memo[c] = ('', (c.pos, c.part, c.side))
+        else:
+            memo[c] = ('~' + type(c).__name__, ())
+    return memo[c]
+
+def junction(op, children, memo):
+    # children are already simplified
+    unit = (op == 'and')
+    ls = []
+    seen = set()
+    for c in children:
+        if c is unit:
+            continue
+        if c is (not unit):
+            return not unit
+        for x in (c.children if is_op(c, op) else [c]):
+            if x not in seen:
+                seen.add(x)
+                ls.append(x)
+    if any(negate(x) in seen for x in ls):
+        return not unit
+    # absorption: a and (a or b) = a
+    other = 'or' if op == 'and' else 'and'
+    ls = [x for x in ls if not (is_op(x, other) and any(y in seen for y in x.children))]
+    if not ls:
+        return unit
+    if len(ls) == 1:
+        return ls[0]
+    ls.sort(key=lambda x: sort_key(x, memo))
+    return Cond(op, ls)
+
+def normalize(c, neg, memo):
+    # negation normal form via De Morgan, flattened and deduplicated
+    key = (c, neg)
+    if key not in memo:
+        if is_op(c, 'not'):
+            memo[key] = normalize(c.children[0], not neg, memo)
+        elif is_op(c, 'and') or is_op(c, 'or'):
+            op = c.op
+            if neg:
+                op = 'or' if op == 'and' else 'and'
+            memo[key] = junction(op, [normalize(x, neg, memo) for x in c.children], memo)
+        else:
+            memo[key] = negate(c) if neg else c
+    return memo[key]
+
+class BDD:
+    # reduced ordered binary decision diagram over the atoms of one guard
+    # nodes are (var, lo, hi) tuples, leaves are True and False
+    def __init__(self, atoms):
+        self.atoms = atoms
+        self.order = {a: i for i, a in enumerate(atoms)}
+        self.nodes = {}
+        self.memo = {}
+    def node(self, v, lo, hi):
+        if lo is hi:
+            return lo
+        return self.nodes.setdefault((v, lo, hi), (v, lo, hi))
+    def apply(self, op, a, b):
+        if isinstance(a, bool) or isinstance(b, bool):
+            if isinstance(b, bool):
+                a, b = b, a
+            if op == 'and':
+                return b if a else False
+            return True if a else b
+        key = (op, a, b)
+        if key not in self.memo:
+            v = min(a[0], b[0])
+            a0, a1 = (a[1], a[2]) if a[0] == v else (a, a)
+            b0, b1 = (b[1], b[2]) if b[0] == v else (b, b)
+            self.memo[key] = self.node(v, self.apply(op, a0, b0), self.apply(op, a1, b1))
+        return self.memo[key]
+    def build(self, c):
+        if is_op(c, 'and') or is_op(c, 'or'):
+            r = self.build(c.children[0])
+            for x in c.children[1:]:
+                r = self.apply(c.op, r, self.build(x))
+            return r
+        elif is_op(c, 'not'):
+            return self.node(self.order[c.children[0]], True, False)
+        return self.node(self.order[c], False, True)
+    def to_cond(self, n, memo):
+        if isinstance(n, bool):
+            return n
+        if n not in memo:
+            v, lo, hi = n
+            a = self.atoms[v]
+            lo = self.to_cond(lo, memo)
+            hi = self.to_cond(hi, memo)
+            memo[n] = junction('or', [junction('and', [a, hi], memo), junction('and', [negate(a), lo], memo)], memo)
+        return memo[n]
+
+def atoms(c, ret):
+    if is_op(c, 'and') or is_op(c, 'or') or is_op(c, 'not'):
+        for x in c.children:
+            atoms(x, ret)
+    elif c not in ret:
+        ret[c] = len(ret)
+    return ret
+
+def simplify(c):
+    # returns an equivalent condition or True or False
+    memo = {}
+    c = normalize(c, False, memo)
+    if isinstance(c, bool):
+        return c
+    ats = list(atoms(c, {}))
+    if len(ats) <= BDDAtoms:
+        b = BDD(ats)
+        c2 = b.to_cond(b.build(c), memo)
+        if isinstance(c2, bool) or guard_size(c2) < guard_size(c):
+            return c2
+    return c
+
 def parse_action(xml, adjust=None):
     if xml.tag == 'action' or xml.tag == 'def-macro':
         return ActionBlock([parse_action(x, adjust) for x in xml])
@@ -395,27 +756,107 @@ def parse_action(xml, adjust=None):
         parm = [p for p in xml if p.tag == 'with-param']
         for i, p in enumerate(parm):
             ad[str(i+1)] = p.attrib['pos']
-        return parse_action(Macros[xml.attrib['n']], ad)
+        # expansions are never mutated, so identical calls can share one
+        global MacroHits, MacroMisses
+        key = (xml.attrib['n'], tuple(sorted(ad.items())))
+        MacroCalls[key[0]] = MacroCalls.get(key[0], 0) + 1
+        if key in MacroCache:
+            MacroHits += 1
+        else:
+            MacroMisses += 1
+            body = parse_action(Macros[xml.attrib['n']], ad)
+            if ShareMacros and macro_def(xml.attrib['n']):
+                body = MacroCall(macro_def(xml.attrib['n']), [p.attrib['pos'] for p in parm], body)
+            MacroCache[key] = body
+        return MacroCache[key]
     else:
         print('not sure what to do with')
         print(etree.tostring(xml))
 
+PathBudget = 10000
+
+class TooManyPaths(Exception):
+    pass
+
+class Budget:
+    # caps how many states one walk may create, since every test can
+    # double the number of paths, see explore
+    def __init__(self, n=PathBudget):
+        self.left = n
+    def spend(self, n=1):
+        self.left -= n
+        if self.left < 0:
+            raise TooManyPaths()
+
+AttrValues = {}
+
+def attr_values(n):
+    # unquoted values of an attr or list, cached per definition
+    if n not in Attrs:
+        return None
+    if n not in AttrValues or AttrValues[n][0] is not Attrs[n]:
+        AttrValues[n] = (Attrs[n], [v[1:-1] if v[:1] == '"' else v for v in Attrs[n]])
+    return AttrValues[n][1]
+
+Tests = {
+    'equal': lambda v, ls: v in ls,
+    'in': lambda v, ls: v in ls,
+    'begins-with': lambda v, ls: any(v.startswith(x) for x in ls),
+    'begins-with-list': lambda v, ls: any(v.startswith(x) for x in ls),
+    'ends-with': lambda v, ls: any(v.endswith(x) for x in ls),
+    'ends-with-list': lambda v, ls: any(v.endswith(x) for x in ls),
+    'contains-substring': lambda v, ls: any(x in v for x in ls),
+}
+
 class State:
     # idea: use this to examine control flow in <choose>
     # see if they can be replaced with tag-replace rules
-    def __init__(self, parts, stage='t1x'):
-        # parts is e.g. [['a_cas', 'a_num'], ['a_tense']]
-        # i.e. list of all clips that are used for each item
-        self.input = {}
-        self.lemmas = {}
-        for i, p in enumerate(parts):
-            self.input[i+1] = {'sl': {}, 'tl': {}, 'ref': {}}
-            self.lemmas[i+1] = []
-            for a in p:
-                self.input[i+1]['tl'] = [[x,x] for x in Attrs[stage][a]]
-                if stage == 't1x':
-                    self.input[i+1]['sl'] = [[x,x] for x in Attrs[stage][a]]
-                    self.input[i+1]['ref'] = [[x,x] for x in Attrs[stage][a]]
+    # the possible values of a clip are a bitmask over its Attrs list,
+    # plus a last bit for "" when the LU has none of them,
+    # a clip with no mask can be anything
+    lems = ('lem', 'lemh', 'lemq', 'lemcase')
+    def __init__(self, masks=None, lemmas=None):
+        self.masks = masks or {}    # (pos, side, part) -> int
+        self.lemmas = lemmas or {}  # pos -> tuple of lemma conditions
+    def key(self, c):
+        if not isinstance(c, Clip) or c.pos in ['lit', 'list', 'var', 'b']:
+            return None
+        if attr_values(c.part) is None:
+            return None
+        return (c.pos, c.side, c.part)
+    def values(self, part):
+        return attr_values(part) + ['']
+    def mask(self, key):
+        return self.masks.get(key, (1 << len(self.values(key[2]))) - 1)
+    def restrict(self, ms):
+        # the states left after intersecting with ms, none if a mask empties
+        masks = dict(self.masks)
+        for k, m in ms.items():
+            m &= self.mask(k)
+            if not m:
+                return []
+            masks[k] = m
+        return [State(masks, self.lemmas)]
+    def assign(self, target, val, budget):
+        k = self.key(target)
+        if k is None:
+            return self
+        masks = dict(self.masks)
+        vs = self.values(k[2])
+        if isinstance(val, Clip) and val.pos == 'lit' and val.part in vs:
+            masks[k] = 1 << vs.index(val.part)
+        elif self.key(val) is not None and val.part == k[2]:
+            masks[k] = self.mask(self.key(val))
+        else:
+            masks.pop(k, None)
+        budget.spend()
+        return State(masks, self.lemmas)
+    def bits(self, part, test, ls, fold):
+        m = 0
+        for i, v in enumerate(self.values(part)):
+            if test(v.lower() if fold else v, ls):
+                m |= 1 << i
+        return m
     def split(self, cond):
         if cond.op == 'not':
             yes, no = self.split(cond.children[0])
@@ -436,130 +877,644 @@ class State:
             no = [self]
             for c in cond.children:
                 new_no = []
-                for y in yes:
-                    a,b = y.split(c)
-                    new_no += b
+                for n in no:
+                    a,b = n.split(c)
                     yes += a
+                    new_no += b
                 no = new_no
             return yes, no
-        else:
+        lem = [c for c in cond.children if isinstance(c, Clip) and c.part in self.lems and c.pos != 'var']
+        if lem:
+            yes = dict(self.lemmas)
+            no = dict(self.lemmas)
+            for c in lem:
+                yes[c.pos] = yes.get(c.pos, ()) + (cond,)
+                no[c.pos] = no.get(c.pos, ()) + (Cond('not', [cond]),)
+            return [State(self.masks, yes)], [State(self.masks, no)]
+        if cond.op not in Tests or len(cond.children) != 2:
+            return [self], [self]
+        a, b = cond.children
+        ka, kb = self.key(a), self.key(b)
+        if ka is None and kb is not None and cond.op == 'equal':
+            a, b, ka, kb = b, a, kb, ka
+        if ka is None:
+            return [self], [self]
+        if kb is not None:
+            # clip against clip: only equal values of one attr can be compared
+            if cond.op != 'equal' or ka[2] != kb[2]:
+                return [self], [self]
+            both = self.mask(ka) & self.mask(kb)
+            yes = self.restrict({ka: both, kb: both})
+            single = both and not both & (both - 1)
+            if single and self.mask(ka) == both and self.mask(kb) == both:
+                return yes, []
+            return yes, [self]
+        if not isinstance(b, Clip) or b.pos not in ['lit', 'list']:
+            return [self], [self]
+        ls = [b.part] if b.pos == 'lit' else attr_values(b.part)
+        if ls is None:
+            return [self], [self]
+        # tests may be caseless, so the yes side matches ignoring case
+        # and the no side only drops exact matches
+        test = Tests[cond.op]
+        yes = self.bits(ka[2], test, [x.lower() for x in ls], True)
+        no = ~self.bits(ka[2], test, ls, False)
+        return self.restrict({ka: yes}), self.restrict({ka: no})
+
+def explore(node, states, budget, reach):
+    # run states through an action and return the states that come out,
+    # reach[choose] gets the states that can take each of its branches
+    # every state a test or let produces is charged to budget, including
+    # the copies made when a test can't tell which way a state goes
+    if not states:
+        return states
+    if isinstance(node, ActionBlock):
+        for p in node.parts:
+            states = explore(p, states, budget, reach)
+        return states
+    elif isinstance(node, Choose):
+        branches = []
+        ret = []
+        for t, d in zip(node.test, node.do):
             yes = []
             no = []
-            lems = ['lem', 'lemh', 'lemq', 'lemcase']
-            has_lem = False
-            for c in cond.children:
-                if c.part in lems and c.pos != 'var':
-                    if not has_lem:
-                        yes = [copy.deepcopy(self)]
-                        no = [copy.deepcopy(self)]
-                    has_lem = True
-                    yes[0].lemmas[c.pos].append(cond)
-                    no[0].lemmas[c.pos].append(Cond('not', [cond]))
-            if has_lem:
-                return yes, no
-            if cond.op == 'equal':
-                pass
-            elif cond.op == 'begins-with':
-                pass
-            elif cond.op == 'begins-with-list':
-                pass
-            elif cond.op == 'ends-with':
-                pass
-            elif cond.op == 'ends-with-list':
-                pass
-            elif cond.op == 'contains-substring':
-                pass
-            elif cond.op == 'in':
-                pass
+            for s in states:
+                a,b = s.split(t)
+                budget.spend(len(a) + len(b))
+                yes += a
+                no += b
+            branches.append(yes)
+            ret += explore(d, yes, budget, reach)
+            states = no
+        branches.append(states)
+        ret += explore(node.otherwise, states, budget, reach)
+        if node in reach:
+            branches = [x + y for x, y in zip(reach[node], branches)]
+        reach[node] = branches
+        return ret
+    elif isinstance(node, MacroCall):
+        return explore(node.body, states, budget, reach)
+    elif isinstance(node, Action):
+        if node.name == 'let':
+            return [s.assign(node.parts[0], node.parts[1], budget) for s in states]
+        elif node.name == 'reject-current-rule':
+            return []
+    return states
+
+def rule_deps(xml):
+    # the part of a rule's cache key that only depends on its own file:
+    # the rule, the macros it calls, and the names of the attrs it uses
+    h = hashlib.sha1(etree.tostring(xml))
+    h.update(str(xml.sourceline).encode())
+    names = []
+    todo = [xml]
+    seen = set()
+    while todo:
+        for x in todo.pop().iter():
+            if x.tag == 'call-macro' and x.attrib['n'] not in seen:
+                m = Macros[x.attrib['n']]
+                seen.add(x.attrib['n'])
+                h.update(etree.tostring(m))
+                h.update(str(m.sourceline).encode())
+                todo.append(m)
+            elif x.tag in ['concat', 'append']:
+                h.update(str(x.sourceline).encode())
+            elif x.tag in ['clip', 'list']:
+                n = x.get('part') or x.get('n')
+                if n not in seen:
+                    seen.add(n)
+                    names.append(n)
+    return h.hexdigest(), names
+
+def source_hash():
+    global SourceHash
+    # the converter and the modules whose results go in snapshots and the cache
+    if SourceHash is None:
+        h = hashlib.sha1()
+        for fname in [__file__, cattrie.__file__]:
+            h.update(open(fname, 'rb').read())
+        SourceHash = h.hexdigest()
+    return SourceHash
+
+def rule_key(pat, deps):
+    # covers everything the converted rule depends on:
+    # the rule, the macros it calls, and the cats and attrs it uses
+    h = hashlib.sha1(source_hash().encode())
+    h.update(repr((Simplify, ShareMacros)).encode())
+    if ShareMacros:
+        # which shared macros the rule calls, and by what names
+        h.update(MacroNames.encode())
+    h.update(deps[0].encode())
+    for n in pat:
+        h.update(repr((n, [l.to_str() for l in Cats.get(n, [])])).encode())
+    for n in deps[1]:
+        if n in Attrs:
+            h.update(repr((n, Attrs[n])).encode())
+    return h.hexdigest()
+
+def cache_load(key):
+    if MemCache is not None and key in MemCache:
+        return MemCache[key]
+    if not CacheDir:
+        return None
+    fname = os.path.join(CacheDir, key + '.json')
+    if os.path.exists(fname):
+        with open(fname) as f:
+            return tuple(json.load(f))
+
+def cache_store(key, val):
+    if MemCache is not None:
+        MemCache[key] = tuple(val)
+    if not CacheDir:
+        return
+    fname = os.path.join(CacheDir, key + '.json')
+    tmp = '%s.%s' % (fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(val, f)
+    os.replace(tmp, fname)
 
 class Rule:
-    def __init__(self, pat, act, line):
+    def __init__(self, pat, act, line, key=None, cached=None, fingerprint=None):
         self.pat = pat
         self.act = act
         self.line = line
-    def to_str(self):
-        print('to_str(%s)' % self.line)
-        maybe_type = self.act.filter(['0', 'pos_tag'])
-        if isinstance(maybe_type, Clip) and maybe_type.pos == 'lit':
-            pos = maybe_type.part
+        self.key = key
+        self.cached = cached
+        self.fingerprint = fingerprint
+    def convert(self):
+        # returns the rtx rule along with what it adds to Output, OutputTags and Stats
+        if self.cached:
+            return self.cached
+        ret = self.convert_uncached()
+        if self.key:
+            cache_store(self.key, ret)
+        return ret
+    def branches(self, budget=None):
+        # the states reaching each branch of each <choose>,
+        # None if the rule has too many paths to follow
+        reach = {}
+        try:
+            explore(self.act, [State()], budget or Budget(), reach)
+        except TooManyPaths:
+            return None
+        return reach
+    def convert_uncached(self):
+        if Verbose:
+            print('to_str(%s)' % self.line)
+        # rules with the same fingerprint only differ in their pattern
+        if self.fingerprint in Bodies:
+            pos, body, stats = Bodies[self.fingerprint]
         else:
-            pos = 'unknown'
-        global Output, OutputTags
-        Output.add(pos)
-        Output.update(self.pat)
+            pos, body, stats = self.convert_body()
+            if self.fingerprint in Repeated or self.fingerprint in BodySeen:
+                Bodies[self.fingerprint] = (pos, body, stats)
+        outs = [pos] + self.pat
+        tags = []
         pat = []
         for p in self.pat:
             if len(Cats[p]) == 1:
                 pat.append(Cats[p][0].to_str())
-                Output.add(Cats[p][0].tags[0])
+                outs.append(Cats[p][0].tags[0])
             else:
                 pat.append(p)
-                Output.add(p)
-                OutputTags.add(p)
-        l = self.act.filter_let()
-        cl = l.get_clips()
-        global LetClips
-        LetClips = [(c, l.filter(c)) for c in cl]
-        varls = [l for l in LetClips if l[0][0] == 'var']
-        chls = [l for l in LetClips if l[0][0] == '0']
-        rj = self.act.filter_reject()
-        out = self.act.filter_out()
+                outs.append(p)
+                tags.append(p)
+        return '! line %s\n%s -> %s' % (self.line, pos, ' '.join(pat)) + body, outs, tags, dict(stats)
+    def convert_body(self):
+        # everything after the pattern, which only depends on the action
+        an = Analysis(self.act)
+        maybe_type = an.lets.get(('0', 'pos_tag'))
+        if isinstance(maybe_type, Clip) and maybe_type.pos == 'lit':
+            pos = maybe_type.part
+        else:
+            pos = 'unknown'
+        env = LetEnv(an.lets.items(), an.assigned)
+        varls = [l for l in env.lets.items() if l[0][0] == 'var']
+        chls = [l for l in env.lets.items() if l[0][0] == '0']
+        rj = an.reject
+        out = an.out
+        stats = {}
+        if Simplify and isinstance(rj, Cond):
+            stats['guard nodes before'] = guard_size(rj)
+            s = simplify(rj)
+            if s is not True:
+                rj = s
+            stats['guard nodes after'] = guard_size(rj) if rj else 0
+        ls = []
         if rj:
-            rej = ' ?' + rj.to_str()
+            ls += [' ?', rj.to_doc(env)]
+        ls.append(' [')
+        glob = [Concat(['$$' + v[0][1] + '= *(unknown)[lem=', v[1].to_doc(env), ']']) for v in varls] + [Concat(['$' + v[0][1] + '=', v[1].to_doc(env)]) for v in chls]
+        for i, g in enumerate(glob):
+            if i > 0:
+                ls.append(', ')
+            ls.append(g)
+        ls += ['] {', out.to_doc(env), '};\n\n']
+        ret = render(Concat(ls))
+        stats.update(env.stats)
+        return pos, ret, stats
+    def to_str(self):
+        s, outs, tags, stats = self.convert()
+        add_result(outs, tags, stats)
+        return s
+
+def add_result(outs, tags, stats):
+    Output.update(dict.fromkeys(outs))
+    OutputTags.update(dict.fromkeys(tags))
+    for k in stats:
+        Stats[k] = Stats.get(k, 0) + stats[k]
+
+def timed(name):
+    # with --stats, adds the time spent inside it to stage name
+    return Prof.stage(name) if Prof else contextlib.nullcontext()
+
+def process_section(x, stage):
+    with timed('definitions'):
+        read_section(x, stage)
+
+def read_section(x, stage):
+    global Macros
+    if x.tag == 'section-def-cats':
+        read_cats(x, stage)
+    elif x.tag == 'section-def-attrs':
+        read_attrs(x, stage)
+    elif x.tag == 'section-def-lists':
+        read_lists(x, stage)
+    elif x.tag == 'section-def-vars':
+        read_vars(x, stage)
+    elif x.tag == 'section-def-macros':
+        Macros = {}
+        MacroCache.clear()
+        MacroDefs.clear()
+        MacroDigests.clear()
+        for mc in x:
+            Macros[mc.attrib['n']] = mc
+        define_macros(stage)
+
+def body_key(xml):
+    # a fingerprint of a rule's action: the action, the macros it calls,
+    # and the lines of anything converted to a message with its line in it
+    # rules with the same fingerprint have the same body once converted
+    h = hashlib.sha1(etree.tostring(xml, with_tail=False))
+    for y in xml.iter('call-macro', 'concat', 'append'):
+        if y.tag == 'call-macro':
+            h.update(macro_digest(y.attrib['n']).encode())
         else:
-            rej = ''
-        glob = ['$$' + v[0][1] + '= *(unknown)[lem=' + v[1].to_str() + ']' for v in varls] + ['$' + v[0][1] + '=' + v[1].to_str() for v in chls]
-        return '! line %s\n%s -> %s%s [%s] {%s};\n\n' % (self.line, pos, ' '.join(pat), rej, ', '.join(glob), out.to_str())
+            h.update(str(y.sourceline).encode())
+    return h.hexdigest()
+
+def macro_digest(name):
+    # body_key of a macro, computed once each time the macros are read
+    # with --share-macros, calls render as the macro's name, which
+    # depends on the file it is in
+    if name not in MacroDigests:
+        MacroDigests[name] = ''
+        MacroDigests[name] = body_key(Macros[name])
+        if ShareMacros:
+            MacroDigests[name] += ' %s' % macro_def(name)
+    return MacroDigests[name]
+
+def read_rule(r):
+    deps = None
+    if CacheDir or MemCache is not None:
+        deps = rule_deps(r)
+    return make_rule([p.attrib['n'] for p in r[0]], r.sourceline, deps, xml=r)
+
+def make_rule(pat, line, deps, act=None, xml=None, fingerprint=None):
+    # the IR is act, or is parsed from xml if the rule isn't cached
+    global CacheHits, CacheMisses
+    if fingerprint is None:
+        fingerprint = body_key(xml[1])
+    key = None
+    if deps:
+        key = rule_key(pat, deps)
+        cached = cache_load(key)
+        if cached:
+            CacheHits += 1
+            return Rule(pat, None, line, key, cached, fingerprint)
+        CacheMisses += 1
+    if act is None:
+        with timed('rules'):
+            act = parse_action(xml[1])
+    return Rule(pat, act, line, key, fingerprint=fingerprint)
 
 def process_file(xml, stage):
-    global Macros
     for x in xml:
-        if x.tag == 'section-def-cats':
-            read_cats(x, stage)
-        elif x.tag == 'section-def-attrs':
-            read_attrs(x, stage)
-        elif x.tag == 'section-def-lists':
-            read_lists(x, stage)
-        elif x.tag == 'section-def-vars':
-            read_vars(x, stage)
-        elif x.tag == 'section-def-macros':
-            Macros = {}
-            for mc in x:
-                Macros[mc.attrib['n']] = mc
-        elif x.tag == 'section-rules':
-            ret = []
-            for r in x:
-                if r.tag != 'rule':
-                    continue
-                ret.append(Rule([p.attrib['n'] for p in r[0]], parse_action(r[1]), r.sourceline))
-            return ret
+        if x.tag == 'section-rules':
+            return [read_rule(r) for r in x if r.tag == 'rule']
+        process_section(x, stage)
+
+def section_defs(x):
+    # what process_section read from x, in a form that can be pickled
+    if x.tag == 'section-def-cats':
+        return ('cats', [(c.attrib['n'], Cats[c.attrib['n']]) for c in x])
+    elif x.tag in ['section-def-attrs', 'section-def-lists']:
+        return ('attrs', [(a.attrib['n'], Attrs[a.attrib['n']]) for a in x])
+    elif x.tag == 'section-def-vars':
+        return ('vars', [v.attrib['n'] for v in x])
+    elif x.tag == 'section-def-macros':
+        return ('macros', [(m.attrib['n'], etree.tostring(m)) for m in x])
+
+def load_defs(defs, stage):
+    global Macros
+    for kind, ls in defs:
+        if kind == 'cats':
+            for n, v in ls:
+                if n in Cats:
+                    print('Warning: name conflict with pattern "%s"' % n)
+                Cats[n] = v
+        elif kind == 'attrs':
+            for n, v in ls:
+                if n in Attrs:
+                    print('Warning: name conflict with attr/list "%s"' % n)
+                Attrs[n] = v
+        elif kind == 'vars':
+            Vars.extend(ls)
+        elif kind == 'macros':
+            # only used for parsing, and the rules come already parsed,
+            # so these lose their line numbers
+            Macros = {n: etree.fromstring(m) for n, m in ls}
+            MacroCache.clear()
+            MacroDefs.clear()
+            MacroDigests.clear()
+            define_macros(stage)
+
+def snapshot_file(fname, stage):
+    # like process_file, but loads the definitions and rule IR from a
+    # snapshot written by an earlier run if the file hasn't changed
+    path = os.path.abspath(fname)
+    st = os.stat(fname)
+    stamp = (st.st_mtime_ns, st.st_size)
+    snap = os.path.join(SnapshotDir, hashlib.sha1(repr((path, stage, ShareMacros)).encode()).hexdigest() + '.pickle')
+    digest = None
+    head = None
+    if os.path.exists(snap):
+        with open(snap, 'rb') as f:
+            try:
+                head = pickle.load(f)
+            except Exception:
+                head = None
+            if head and head['version'] == SnapshotVersion and head['source'] == source_hash():
+                if head['stamp'] != stamp:
+                    digest = hashlib.sha1(open(fname, 'rb').read()).hexdigest()
+                if head['stamp'] == stamp or head['hash'] == digest:
+                    start = time.time()
+                    with timed('snapshot'):
+                        defs, recs = pickle.load(f)
+                    with timed('definitions'):
+                        load_defs(defs, stage)
+                    if head['stamp'] != stamp:
+                        # touched but not changed, so next time the stamp is enough
+                        head['stamp'] = stamp
+                        write_snapshot(snap, head, defs, recs)
+                    print('loaded snapshot of %s in %.2fs (parsing took %.2fs)' % (fname, time.time() - start, head['time']))
+                    return snapshot_rules(recs)
+    start = time.time()
+    if digest is None:
+        digest = hashlib.sha1(open(fname, 'rb').read()).hexdigest()
+    defs = []
+    recs = []
+    for x in parse(fname):
+        if x.tag == 'section-rules':
+            with timed('rules'):
+                recs = [([p.attrib['n'] for p in r[0]], parse_action(r[1]), r.sourceline, rule_deps(r), body_key(r[1])) for r in x if r.tag == 'rule']
+            break
+        process_section(x, stage)
+        if section_defs(x):
+            defs.append(section_defs(x))
+    took = time.time() - start
+    print('parsed %s in %.2fs' % (fname, took))
+    head = {'version': SnapshotVersion, 'source': source_hash(), 'stamp': stamp, 'hash': digest, 'time': took}
+    write_snapshot(snap, head, defs, recs)
+    return snapshot_rules(recs)
+
+def write_snapshot(snap, head, defs, recs):
+    with timed('snapshot'):
+        tmp = '%s.%s' % (snap, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(head, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((defs, recs), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snap)
 
-if len(sys.argv) < 3 or len(sys.argv) > 4:
-    print('usage: trx_to_rtx.py t1x [t2x] rtx')
-else:
-    t1x = etree.parse(sys.argv[1], parser=etree.ETCompatXMLParser()).getroot()
-    print('process t1x')
-    rls1 = process_file(t1x, 't1x')
-    print('done with t1x')
-    t2x = None
+def snapshot_rules(recs):
+    keep = CacheDir or MemCache is not None
+    return [make_rule(pat, line, deps if keep else None, act=act, fingerprint=fp) for pat, act, line, deps, fp in recs]
+
+def stream_file(fname, stage):
+    # like process_file, but reads the file incrementally and yields each
+    # rule as soon as it is complete, after which its xml is thrown away
+    events = etree.iterparse(fname, remove_comments=True, remove_pis=True)
+    while True:
+        with timed('parse'):
+            ev, x = next(events, (None, None))
+        if x is None:
+            break
+        par = x.getparent()
+        if par is None:
+            continue
+        if x.tag == 'rule' and par.tag == 'section-rules':
+            yield read_rule(x)
+            x.clear()
+            while x.getprevious() is not None:
+                del par[0]
+        elif par.getparent() is None and x.tag != 'section-rules':
+            process_section(x, stage)
+
+def init_worker(cats, cache_dir, simplify, verbose):
+    global Cats, CacheDir, Simplify, Verbose
+    Cats = cats
+    CacheDir = cache_dir
+    Simplify = simplify
+    Verbose = verbose
+
+def render_chunk(rules):
+    # rules is [(rule, whether it repeats)]
+    # each result comes with how long it took, for --stats, and, if it
+    # repeats, its body so the main process can reuse it for the others
+    ret = []
+    for r, repeats in rules:
+        if repeats:
+            Repeated.add(r.fingerprint)
+        start = time.perf_counter()
+        ret.append((r.convert(), time.perf_counter() - start, Bodies.pop(r.fingerprint, None)))
+        Repeated.discard(r.fingerprint)
+    return ret
+
+def count_body(r, s):
+    if r.fingerprint in BodySeen:
+        Stats['repeated bodies'] = Stats.get('repeated bodies', 0) + 1
+        Stats['repeated body bytes'] = Stats.get('repeated body bytes', 0) + len(s)
+    else:
+        BodySeen.add(r.fingerprint)
+
+def render_rules(rules, pool=None, jobs=1):
+    # yields the converted rules in order, updating Output and OutputTags
+    if isinstance(rules, list):
+        counts = {}
+        for r in rules:
+            counts[r.fingerprint] = counts.get(r.fingerprint, 0) + 1
+        Repeated.update(fp for fp, n in counts.items() if n > 1)
+    if not pool:
+        for r in rules:
+            start = time.perf_counter()
+            with timed('render'):
+                s = r.to_str()
+            if Prof:
+                Prof.rule(r.line, time.perf_counter() - start, len(s))
+            count_body(r, s)
+            yield s
+        return
+    # only the first rule with each fingerprint goes to the workers,
+    # the others are converted here from its body
+    first = {}
+    for r in rules:
+        first.setdefault(r.fingerprint, r)
+    todo = [(r, fp in Repeated) for fp, r in first.items()]
+    size = max(1, len(todo) // (jobs * 4))
+    chunks = [todo[i:i+size] for i in range(0, len(todo), size)]
+    done = {}
+    with timed('render'):
+        for chunk, ls in zip(chunks, pool.map(render_chunk, chunks)):
+            for (r, repeats), (ret, secs, body) in zip(chunk, ls):
+                done[r] = (ret, secs)
+                if body:
+                    Bodies[r.fingerprint] = body
+    for r in rules:
+        # merged in rule order so the sets end up as if rendered here
+        if r in done:
+            ret, secs = done[r]
+        else:
+            start = time.perf_counter()
+            with timed('render'):
+                ret = r.convert()
+            secs = time.perf_counter() - start
+        s, outs, tags, stats = ret
+        add_result(outs, tags, stats)
+        if Prof:
+            Prof.rule(r.line, secs, len(s))
+        count_body(r, s)
+        yield s
+
+def reset():
+    # forget everything read by the previous conversion
+    global Cats, Attrs, Vars, Lists, Macros, Output, OutputTags, Stats
+    global MacroHits, MacroMisses, CacheHits, CacheMisses, MacroNames
+    Cats = {}
+    Attrs = {}
+    Vars = []
+    Lists = {}
+    Macros = {}
+    Output = {}
+    OutputTags = {}
+    Stats = {}
+    MacroCache.clear()
+    MacroCalls.clear()
+    Bodies.clear()
+    BodySeen.clear()
+    Repeated.clear()
+    MacroDigests.clear()
+    MacroDefs.clear()
+    MacroNames = ''
+    SharedMacros.clear()
+    MacroHits = MacroMisses = CacheHits = CacheMisses = 0
+
+def warm():
+    # keep parsed files and converted rules in memory between conversions
+    global MemCache, Trees
+    MemCache = {}
+    Trees = {}
+
+def parse(fname):
+    if Trees is None:
+        with timed('parse'):
+            return etree.parse(fname, parser=etree.ETCompatXMLParser()).getroot()
+    st = os.stat(fname)
+    path = os.path.abspath(fname)
+    stamp = (st.st_mtime_ns, st.st_size)
+    if path not in Trees or Trees[path][0] != stamp:
+        with timed('parse'):
+            Trees[path] = (stamp, etree.parse(fname, parser=etree.ETCompatXMLParser()).getroot())
+    return Trees[path][1]
+
+def read_file(fname, stage):
+    if SnapshotDir:
+        return snapshot_file(fname, stage)
+    return process_file(parse(fname), stage)
+
+def convert(files, rtx, jobs=1, cache=None, stream=False, simplify=False, cmd=None, snapshot=None, stats=None, top=10, verbose=0, keep_unchanged=False, share_macros=False):
+    # files is [t1x] or [t1x, t2x], cmd is the command recorded in the header
+    # stats is where to write the --stats report, listing the top slowest and largest rules
+    global Simplify, CacheDir, SnapshotDir, Verbose, Prof, ShareMacros
+    reset()
+    Simplify = simplify
+    ShareMacros = share_macros
+    CacheDir = cache
+    SnapshotDir = snapshot
+    Verbose = verbose
+    Prof = runstats.Profile(top) if stats else None
+    for d in [CacheDir, SnapshotDir]:
+        if d:
+            os.makedirs(d, exist_ok=True)
+    try:
+        write_rtx(files, rtx, jobs, stream, cmd, keep_unchanged)
+    finally:
+        # also when it fails, so a server doesn't go on tracing memory
+        if Prof:
+            prof, Prof = Prof, None
+            prof.report(stats, **{'macro expansions': MacroCalls, 'macro cache': {'hits': MacroHits, 'misses': MacroMisses}})
+
+def write_rtx(files, rtx, jobs, stream, cmd, keep_unchanged):
     rls2 = []
-    if len(sys.argv) == 4:
-        print('process t2x')
-        t2x = etree.parse(sys.argv[2], parser=etree.ETCompatXMLParser()).getroot()
-        rls2 = process_file(t2x, 't2x')
-        print('done with t2x')
-    rtx = sys.argv[-1]
+    if stream:
+        rls1 = stream_file(files[0], 't1x')
+        if len(files) == 2:
+            rls2 = stream_file(files[1], 't2x')
+        body = tempfile.TemporaryFile('w+')
+    else:
+        print('process t1x')
+        rls1 = read_file(files[0], 't1x')
+        print('done with t1x')
+        if len(files) == 2:
+            print('process t2x')
+            rls2 = read_file(files[1], 't2x')
+            print('done with t2x')
+        body = io.StringIO()
     r0s = []
-    print('t1x')
-    r1s = [r.to_str() for r in rls1]
-    print('t2x')
-    r2s = [r.to_str() for r in rls2]
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, (Cats, CacheDir, Simplify, Verbose))
+    try:
+        print('t1x')
+        body.write('!!! Rules from %s\n\n' % files[0])
+        for s in render_rules(rls1, pool, jobs):
+            with timed('write'):
+                body.write(s)
+        print('t2x')
+        for i, s in enumerate(render_rules(rls2, pool, jobs)):
+            with timed('write'):
+                if i == 0:
+                    body.write('!!! Rules from %s\n\n' % files[1])
+                body.write(s)
+    finally:
+        if pool:
+            pool.terminate()
+    print('macro cache: %s hits, %s misses' % (MacroHits, MacroMisses))
+    if CacheDir:
+        print('rule cache: %s reused, %s recomputed' % (CacheHits, CacheMisses))
+    print('rule bodies: %s distinct, %s repeating an earlier rule (%s bytes)' % (len(BodySeen), Stats.get('repeated bodies', 0), Stats.get('repeated body bytes', 0)))
+    if Simplify:
+        print('reject guards: %s nodes before simplifying, %s after' % (Stats.get('guard nodes before', 0), Stats.get('guard nodes after', 0)))
+    macros = ''
+    if ShareMacros:
+        for n, (npar, doc) in SharedMacros.items():
+            macros += '%s(%s): {%s};\n\n' % (n, ', '.join(str(i + 1) for i in range(npar)), doc)
+        print('shared macros: %s written once, %s calls shared, %s inlined, rules %s bytes shorter (for reading only: inline them before compiling)' % (len(SharedMacros), Stats.get('shared macro calls', 0), Stats.get('shared macro calls inlined', 0), Stats.get('shared macro bytes saved', 0)))
     print('generating pattern rules')
     for k in OutputTags:
         for c in Cats[k]:
             r0s.append('%s -> %s {1};\n' % (k, c.to_str()))
-    f = open(rtx, 'w')
-    f.write('''! This file was automatically generated with
+    with timed('write'), outfile.open_output(rtx, keep_unchanged) as f:
+        f.write('''! This file was automatically generated with
 ! $ %s
 ! Everything should be double-checked, particularly the following:
 ! - Can't always infer tag order
@@ -578,11 +1533,42 @@ else:
 
 %s
 
-''' % (' '.join(sys.argv), '\n'.join('%s = %s ;' % (k, ' '.join(Attrs[k])) for k in Attrs), '\n'.join('%s: _;' % k for k in Output)))
-    if r0s:
-        f.write(''.join(r0s) + '\n\n')
-    f.write('!!! Rules from %s\n\n' % sys.argv[1])
-    f.write(''.join(r1s))
-    if r2s:
-        f.write('!!! Rules from %s\n\n' % sys.argv[2])
-        f.write(''.join(r2s))
+''' % (cmd or ' '.join(sys.argv), '\n'.join('%s = %s ;' % (k, ' '.join(Attrs[k])) for k in Attrs), '\n'.join('%s: _;' % k for k in Output)))
+        if r0s:
+            f.write(''.join(r0s) + '\n\n')
+        if macros:
+            f.write('!!! MACROS\n\n! called from the rules as name(positions), rtx has no equivalent\n! so these need to be inlined by hand\n\n' + macros)
+        body.seek(0)
+        shutil.copyfileobj(body, f)
+
+def main(argv, prog='trx_to_rtx.py'):
+    parser = argparse.ArgumentParser(prog=prog, allow_abbrev=False, usage='trx_to_rtx.py [-j N] [--cache DIR] [--snapshot DIR] [--stream] [--simplify] [--stats FILE] [--keep-unchanged] [--share-macros] [-v] t1x [t2x] rtx\n       trx_to_rtx.py [-j N] --batch MANIFEST')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='render rules (or with --batch, run jobs) in N processes')
+    parser.add_argument('--batch', metavar='MANIFEST', help='run each line of MANIFEST as a separate conversion')
+    parser.add_argument('--cache', metavar='DIR', help='reuse rules converted on previous runs')
+    parser.add_argument('--snapshot', metavar='DIR', help='reuse definitions and rules parsed on previous runs')
+    parser.add_argument('--stream', action='store_true', help='convert rules while reading the input')
+    parser.add_argument('--simplify', action='store_true', help='simplify the conditions under which rules reject')
+    parser.add_argument('--stats', metavar='FILE', help='write the time and memory taken by each stage to FILE as JSON')
+    parser.add_argument('--stats-top', metavar='N', type=int, default=10, help='list the N slowest and largest rules in --stats')
+    parser.add_argument('--keep-unchanged', action='store_true', help="don't rewrite rtx if it would stay the same")
+    parser.add_argument('--share-macros', action='store_true', help='for reading the output: write macros that only output once, instead of at every call (rtx-comp won\'t compile the result)')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='print each rule as it is converted')
+    # options can come between the files
+    args = parser.parse_intermixed_args(argv)
+    if args.batch:
+        if args.files:
+            parser.error('--batch does not take files')
+        sys.exit(batch.run_batch(args.batch, 'trx_to_rtx', prog, args.jobs))
+    if len(args.files) < 2 or len(args.files) > 3:
+        parser.print_usage()
+        sys.exit(1)
+    if args.stream and args.jobs > 1:
+        parser.error('--stream cannot be combined with --jobs')
+    if args.stream and args.snapshot:
+        parser.error('--stream cannot be combined with --snapshot')
+    convert(args.files[:-1], args.files[-1], args.jobs, args.cache, args.stream, args.simplify, ' '.join([prog] + argv), args.snapshot, args.stats, args.stats_top, args.verbose, args.keep_unchanged, args.share_macros)
+
+if __name__ == '__main__':
+    main(sys.argv[1:], sys.argv[0])